@@ -0,0 +1,76 @@
+"""Micro-benchmark for building and serializing Gemini request bodies.
+
+Compares the request templates (static members serialized once, orjson when
+installed) with building the whole request dict and running ``json.dumps`` on
+every call, as the service used to. Reports CPU time and peak allocation per
+request for a range of chat history lengths. Run from the repository root:
+
+    python -m benchmarks.bench_request_encoding [--turns 1,10,50] [--iterations 20000]
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+from services import request_templates as templates
+from services.media import encode_request_body, orjson
+
+def _history(turns: int) -> list:
+    contents = []
+    for index in range(turns):
+        contents.append({"role": "user", "parts": [{"text": f"Вопрос номер {index}: как дела у модели?"}]})
+        contents.append({"role": "model", "parts": [{"text": "Ответ модели, " * 20}]})
+    contents.append({"role": "user", "parts": [{"text": "Последний вопрос"}]})
+    return contents
+
+def encode_inline(contents: list) -> bytes:
+    json_data = {
+        "contents": contents,
+        "systemInstruction": {"parts": [{"text": templates.TEXT.system_prompt}]},
+        "safetySettings": [
+            {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+            {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+        ],
+    }
+    return json.dumps(json_data, ensure_ascii=False).encode("utf-8")
+
+def encode_template(contents: list) -> bytes:
+    body, _ = encode_request_body({"contents": contents}, templates.TEXT.static)
+    return body
+
+def measure(encode, contents: list, iterations: int) -> dict:
+    started = time.process_time()
+    for _ in range(iterations):
+        encode(contents)
+    cpu = time.process_time() - started
+
+    tracemalloc.start()
+    encode(contents)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"us_per_request": round(cpu / iterations * 1e6, 2), "peak_alloc_bytes": peak}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", default="1,10,50", help="comma separated chat history lengths")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for turns in args.turns.split(","):
+        contents = _history(int(turns))
+        if json.loads(encode_inline(contents)) != json.loads(encode_template(contents)):
+            raise AssertionError("template body differs from the inline body")
+        inline = measure(encode_inline, contents, args.iterations)
+        template = measure(encode_template, contents, args.iterations)
+        print(json.dumps({
+            "turns": int(turns),
+            "orjson": orjson is not None,
+            "inline": inline,
+            "template": template,
+            "cpu_speedup": round(inline["us_per_request"] / template["us_per_request"], 2),
+        }))
+
+if __name__ == "__main__":
+    main()
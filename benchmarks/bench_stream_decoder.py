@@ -0,0 +1,103 @@
+"""Micro-benchmark for services.stream_decoder.StreamDecoder.
+
+Builds multi-megabyte synthetic Gemini streams (SSE and JSON-array framing), cuts
+them at random byte boundaries and checks that every token comes back out while
+measuring throughput. Run from the repository root:
+
+    python -m benchmarks.bench_stream_decoder [--sizes 1,4,16] [--seed 1]
+"""
+import argparse
+import json
+import random
+import time
+
+from services.stream_decoder import StreamDecoder, TextDelta, FinishReason, UsageMetadata
+
+WORDS = ["привет", "мир", "Gemini", "токен", "\"quoted\"", "back\\slash", "{brace}", "emoji 🚀", "line\nbreak", "ok"]
+
+def _make_tokens(target_bytes: int, rng: random.Random) -> list:
+    tokens = []
+    size = 0
+    while size < target_bytes:
+        token = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        tokens.append(token)
+        size += len(token.encode("utf-8")) + 80
+    return tokens
+
+def _chunk_payload(text: str, finish: bool) -> dict:
+    candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    payload = {"candidates": [candidate]}
+    if finish:
+        candidate["finishReason"] = "STOP"
+        payload["usageMetadata"] = {"promptTokenCount": 10, "candidatesTokenCount": 1, "totalTokenCount": 11}
+    return payload
+
+def build_stream(tokens: list, framing: str) -> bytes:
+    last = len(tokens) - 1
+    if framing == "sse":
+        return b"".join(
+            b"data: " + json.dumps(_chunk_payload(t, i == last), ensure_ascii=False).encode("utf-8") + b"\r\n\r\n"
+            for i, t in enumerate(tokens)
+        )
+    body = ",\r\n".join(json.dumps(_chunk_payload(t, i == last), indent=2, ensure_ascii=False) for i, t in enumerate(tokens))
+    return ("[" + body + "]").encode("utf-8")
+
+def split_randomly(data: bytes, rng: random.Random, max_chunk: int) -> list:
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        step = rng.randint(1, max_chunk)
+        chunks.append(data[pos:pos + step])
+        pos += step
+    return chunks
+
+def run_case(size_mb: float, framing: str, rng: random.Random, max_chunk: int) -> dict:
+    tokens = _make_tokens(int(size_mb * 1024 * 1024), rng)
+    stream = build_stream(tokens, framing)
+    chunks = split_randomly(stream, rng, max_chunk)
+
+    decoder = StreamDecoder()
+    parts = []
+    finished = False
+    usage = None
+    started = time.perf_counter()
+    for chunk in chunks:
+        for event in decoder.feed(chunk):
+            if isinstance(event, TextDelta):
+                parts.append(event.text)
+            elif isinstance(event, FinishReason):
+                finished = True
+            elif isinstance(event, UsageMetadata):
+                usage = event
+    for event in decoder.close():
+        if isinstance(event, TextDelta):
+            parts.append(event.text)
+    elapsed = time.perf_counter() - started
+
+    lost = len(tokens) - len(parts)
+    if parts != tokens or not finished or usage is None:
+        raise AssertionError(f"{framing} {size_mb}MB: decoded stream does not match ({lost} tokens lost)")
+    return {
+        "framing": framing,
+        "size_mb": round(len(stream) / 1024 / 1024, 2),
+        "chunks": len(chunks),
+        "tokens": len(tokens),
+        "seconds": round(elapsed, 4),
+        "mb_per_s": round(len(stream) / 1024 / 1024 / elapsed, 1),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1,4,16", help="comma separated stream sizes in MB")
+    parser.add_argument("--max-chunk", type=int, default=4096, help="largest random chunk in bytes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    for framing in ("sse", "json"):
+        for size in args.sizes.split(","):
+            result = run_case(float(size), framing, rng, args.max_chunk)
+            print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
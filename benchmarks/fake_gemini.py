@@ -0,0 +1,244 @@
+"""Local stand-in for the generativelanguage API.
+
+Serves ``streamGenerateContent`` (SSE and JSON-array framing), the resumable
+Files API upload, ``files/*`` lookups and deletes, ``cachedContents`` (create, renew,
+delete), with configurable latency, token rate and fault injection. Run standalone with
+
+    python -m benchmarks.fake_gemini --port 8081 --fault-rate 0.1
+
+and point the bot at it with ``GEMINI_BASE_URL=http://127.0.0.1:8081``.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, Tuple
+
+from benchmarks.http_server import MiniHTTPServer, Request, Response, ConnectionCut
+
+@dataclass
+class FakeGeminiConfig:
+    ttft: float = 0.3  # seconds before the first chunk
+    tokens_per_second: float = 200.0
+    reply_tokens: int = 120
+    tokens_per_chunk: int = 8
+    fault_rate: float = 0.0  # share of requests answered with 503
+    quota_rate: float = 0.0  # share of requests answered with 429 + retryDelay
+    cut_rate: float = 0.0  # share of streams dropped halfway through
+    down_models: Tuple[str, ...] = ()  # models that answer every request with 503
+    prefill_tokens_per_second: float = 0.0  # uncached prompt tokens read before the first chunk, 0 ignores prompt size
+    seed: int = 0
+
+@dataclass
+class FakeGeminiStats:
+    requests: int = 0
+    stream_requests: int = 0
+    upload_requests: int = 0
+    files_deleted: int = 0
+    faults: int = 0
+    cuts: int = 0
+    request_bytes: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    caches_created: int = 0
+    cache_misses: int = 0
+    by_model: Dict[str, int] = field(default_factory=dict)
+
+_GENERATE = re.compile(r"^/v1beta/models/([^/:]+):(streamGenerateContent|generateContent)$")
+_CACHED_CONTENT = re.compile(r"^/v1beta/(cachedContents/[^/]+)$")
+WORDS = ["модель", "ответ", "данные", "Gemini", "пример", "текст", "быстро", "поток"]
+
+def _count_tokens(contents: list) -> int:
+    return len(json.dumps(contents, ensure_ascii=False)) // 4
+
+class FakeGeminiServer:
+    def __init__(self, config: FakeGeminiConfig = None, port: int = 0):
+        self.config = config or FakeGeminiConfig()
+        self.stats = FakeGeminiStats()
+        self.server = MiniHTTPServer(self.handle, port=port)
+        self._rng = random.Random(self.config.seed)
+        self._uploads: Dict[str, dict] = {}
+        self._files: Dict[str, dict] = {}
+        self._caches: Dict[str, dict] = {}
+
+    @property
+    def url(self) -> str:
+        return self.server.url
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    async def handle(self, request: Request) -> Response:
+        self.stats.requests += 1
+        self.stats.request_bytes += len(request.body)
+        match = _GENERATE.match(request.path)
+        if match:
+            return await self._generate(request, match.group(1), match.group(2))
+        if request.path == "/v1beta/cachedContents" and request.method == "POST":
+            return self._create_cache(request)
+        match = _CACHED_CONTENT.match(request.path)
+        if match:
+            return self._cached_content(request, match.group(1))
+        if request.path == "/upload/v1beta/files":
+            return self._start_upload(request)
+        if request.path.startswith("/upload-session/"):
+            return self._upload_chunk(request)
+        if request.path.startswith("/v1beta/files/"):
+            name = request.path[len("/v1beta/"):]
+            file_info = self._files.get(name)
+            if file_info is None:
+                return Response(404, {"error": {"code": 404}})
+            if request.method == "DELETE":
+                del self._files[name]
+                self.stats.files_deleted += 1
+                return Response(200, {})
+            return Response(200, file_info)
+        return Response(404, {"error": {"code": 404, "message": f"Unknown path {request.path}"}})
+
+    async def _generate(self, request: Request, model: str, method: str) -> Response:
+        self.stats.stream_requests += 1
+        self.stats.by_model[model] = self.stats.by_model.get(model, 0) + 1
+        roll = self._rng.random()
+        if roll < self.config.fault_rate or model in self.config.down_models:
+            self.stats.faults += 1
+            return Response(503, {"error": {"code": 503, "status": "UNAVAILABLE"}}, headers={"Retry-After": "0.2"})
+        if roll < self.config.fault_rate + self.config.quota_rate:
+            self.stats.faults += 1
+            return Response(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED",
+                                            "details": [{"retryDelay": "0.5s"}]}})
+
+        payload = request.json()
+        prompt_tokens = _count_tokens(payload.get("contents", []))
+        cached_tokens = 0
+        if payload.get("cachedContent"):
+            cache = self._caches.get(payload["cachedContent"])
+            if cache is None or cache["expires_at"] < time.monotonic():
+                self.stats.cache_misses += 1
+                return Response(404, {"error": {"code": 404, "status": "NOT_FOUND", "message": "CachedContent not found"}})
+            if cache["model"] != f"models/{model}":
+                return Response(400, {"error": {"code": 400, "status": "INVALID_ARGUMENT", "message": "Model mismatch"}})
+            cached_tokens = cache["tokens"]
+        self.stats.prompt_tokens += prompt_tokens + cached_tokens
+        self.stats.cached_tokens += cached_tokens
+        cut = self._rng.random() < self.config.cut_rate
+        if cut:
+            self.stats.cuts += 1
+        sse = request.query.get("alt") == "sse"
+        return Response(200, headers={"Content-Type": "text/event-stream" if sse else "application/json"},
+                        stream=self._stream(sse, prompt_tokens, cut, cached_tokens))
+
+    def _create_cache(self, request: Request) -> Response:
+        payload = request.json()
+        tokens = _count_tokens(payload.get("contents", [])) + _count_tokens([payload.get("systemInstruction") or {}])
+        ttl = float(payload.get("ttl", "3600s").rstrip("s"))
+        self.stats.caches_created += 1
+        name = f"cachedContents/fake-{self.stats.caches_created}"
+        self._caches[name] = {"model": payload.get("model"), "tokens": tokens, "expires_at": time.monotonic() + ttl}
+        return Response(200, {"name": name, "model": payload.get("model"), "usageMetadata": {"totalTokenCount": tokens}})
+
+    def _cached_content(self, request: Request, name: str) -> Response:
+        cache = self._caches.get(name)
+        if cache is None or cache["expires_at"] < time.monotonic():
+            self._caches.pop(name, None)
+            return Response(404, {"error": {"code": 404, "status": "NOT_FOUND"}})
+        if request.method == "DELETE":
+            del self._caches[name]
+            return Response(200, {})
+        if request.method == "PATCH":
+            cache["expires_at"] = time.monotonic() + float(request.json().get("ttl", "3600s").rstrip("s"))
+        return Response(200, {"name": name, "model": cache["model"], "usageMetadata": {"totalTokenCount": cache["tokens"]}})
+
+    async def _stream(self, sse: bool, prompt_tokens: int, cut: bool, cached_tokens: int = 0) -> AsyncIterator[bytes]:
+        config = self.config
+        prefill = prompt_tokens / config.prefill_tokens_per_second if config.prefill_tokens_per_second else 0
+        await asyncio.sleep(config.ttft + prefill)
+        chunks = max(1, config.reply_tokens // config.tokens_per_chunk)
+        delay = config.tokens_per_chunk / config.tokens_per_second if config.tokens_per_second else 0
+        if not sse:
+            yield b"["
+        for index in range(chunks):
+            if cut and index == chunks // 2:
+                raise ConnectionCut()
+            last = index == chunks - 1
+            text = " ".join(self._rng.choice(WORDS) for _ in range(config.tokens_per_chunk)) + " "
+            candidate = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+            body = {"candidates": [candidate]}
+            if last:
+                candidate["finishReason"] = "STOP"
+                body["usageMetadata"] = {"promptTokenCount": prompt_tokens + cached_tokens,
+                                         "cachedContentTokenCount": cached_tokens,
+                                         "candidatesTokenCount": config.reply_tokens,
+                                         "totalTokenCount": prompt_tokens + cached_tokens + config.reply_tokens}
+            encoded = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            if sse:
+                yield b"data: " + encoded + b"\r\n\r\n"
+            else:
+                yield (b"" if index == 0 else b",\r\n") + encoded
+            if delay and not last:
+                await asyncio.sleep(delay)
+        if not sse:
+            yield b"]"
+
+    def _start_upload(self, request: Request) -> Response:
+        self.stats.upload_requests += 1
+        session = f"{len(self._uploads) + 1}"
+        self._uploads[session] = {
+            "size": int(request.headers.get("x-goog-upload-header-content-length", 0)),
+            "mime_type": request.headers.get("x-goog-upload-header-content-type", "application/octet-stream"),
+            "received": 0,
+        }
+        return Response(200, headers={"X-Goog-Upload-URL": f"{self.url}/upload-session/{session}"})
+
+    def _upload_chunk(self, request: Request) -> Response:
+        self.stats.upload_requests += 1
+        upload = self._uploads.get(request.path.rsplit("/", 1)[-1])
+        if upload is None:
+            return Response(404, {"error": {"code": 404}})
+        command = request.headers.get("x-goog-upload-command", "")
+        if command == "query":
+            return Response(200, headers={"X-Goog-Upload-Size-Received": str(upload["received"])})
+        offset = int(request.headers.get("x-goog-upload-offset", 0))
+        if offset != upload["received"]:
+            return Response(400, {"error": {"code": 400, "message": "offset mismatch"}})
+        upload["received"] += len(request.body)
+        if "finalize" not in command:
+            return Response(200)
+        name = f"files/fake-{len(self._files) + 1}"
+        file_info = {"name": name, "uri": f"{self.url}/v1beta/{name}", "mimeType": upload["mime_type"],
+                     "sizeBytes": str(upload["received"]), "state": "ACTIVE"}
+        self._files[name] = file_info
+        return Response(200, {"file": file_info})
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fake Gemini API server")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--fault-rate", type=float, default=0.0)
+    parser.add_argument("--quota-rate", type=float, default=0.0)
+    parser.add_argument("--cut-rate", type=float, default=0.0)
+    parser.add_argument("--down-model", action="append", default=[], help="model that always answers 503")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = FakeGeminiConfig(ttft=args.ttft, tokens_per_second=args.tokens_per_second, reply_tokens=args.reply_tokens,
+                              fault_rate=args.fault_rate, quota_rate=args.quota_rate, cut_rate=args.cut_rate,
+                              down_models=tuple(args.down_model), prefill_tokens_per_second=args.prefill_tokens_per_second)
+
+    async def serve():
+        server = FakeGeminiServer(config, port=args.port)
+        await server.start()
+        print(f"Fake Gemini API listening on {server.url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Local stand-in for the Telegram Bot API.
+
+Answers the methods the bot uses (getMe, sendMessage, editMessageText, getFile,
+answerCallbackQuery, ...) and serves file downloads, recording when each chat
+received text so the load runner can measure time to first token and latency.
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from urllib.parse import parse_qs
+
+from benchmarks.http_server import MiniHTTPServer, Request, Response
+
+PLACEHOLDER_TEXT = "…"
+
+@dataclass
+class ChatTimeline:
+    first_text_at: Optional[float] = None
+    final_at: Optional[float] = None
+    messages: int = 0
+    edits: int = 0
+    final_event: asyncio.Event = field(default_factory=asyncio.Event)
+
+MAX_MESSAGE_LENGTH = 4096
+
+class FakeTelegramServer:
+    def __init__(self, bot_id: int = 1, port: int = 0, flood_rate: float = 0.0, seed: int = 0):
+        self.bot_id = bot_id
+        self.flood_rate = flood_rate  # share of sends/edits answered with 429 retry_after
+        self._rng = random.Random(seed)
+        self.flood_errors = 0
+        self.too_long = 0
+        self.server = MiniHTTPServer(self.handle, port=port)
+        self.files: Dict[str, bytes] = {}
+        self.timelines: Dict[int, ChatTimeline] = {}
+        self.method_counts: Dict[str, int] = {}
+        self.downloaded_bytes = 0
+        self._message_id = 0
+
+    @property
+    def url(self) -> str:
+        return self.server.url
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    def add_file(self, file_id: str, data: bytes) -> None:
+        self.files[file_id] = data
+
+    def expect_reply(self, chat_id: int) -> ChatTimeline:
+        """Reset the timeline of a chat before sending it a new update."""
+        timeline = self.timelines[chat_id] = ChatTimeline()
+        return timeline
+
+    @staticmethod
+    def _params(request: Request) -> dict:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            return request.json()
+        params = {}
+        for key, values in parse_qs(request.body.decode("utf-8")).items():
+            value = values[-1]
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+
+    async def handle(self, request: Request) -> Response:
+        if request.path.startswith("/file/"):
+            data = self.files.get(request.path.rsplit("/", 1)[-1])
+            if data is None:
+                return Response(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            self.downloaded_bytes += len(data)
+            return Response(200, data, headers={"Content-Type": "application/octet-stream"})
+
+        method = request.path.rsplit("/", 1)[-1]
+        self.method_counts[method] = self.method_counts.get(method, 0) + 1
+        params = self._params(request)
+        if "chat_id" in params and self.flood_rate and self._rng.random() < self.flood_rate:
+            self.flood_errors += 1
+            return Response(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}})
+        if len(params.get("text", "")) > MAX_MESSAGE_LENGTH:
+            self.too_long += 1
+            return Response(400, {"ok": False, "error_code": 400, "description": "Bad Request: message is too long"})
+        handler = getattr(self, f"_method_{method}", None)
+        if handler is None:
+            return Response(200, {"ok": True, "result": True})
+        return Response(200, {"ok": True, "result": handler(params)})
+
+    def _record(self, chat_id: int, text: str, final: bool, edit: bool) -> None:
+        timeline = self.timelines.setdefault(chat_id, ChatTimeline())
+        now = time.perf_counter()
+        if edit:
+            timeline.edits += 1
+        else:
+            timeline.messages += 1
+        if timeline.first_text_at is None and text and text != PLACEHOLDER_TEXT:
+            timeline.first_text_at = now
+        if final and timeline.final_at is None:
+            timeline.final_at = now
+            timeline.final_event.set()
+
+    def _message(self, chat_id: int, text: str, message_id: Optional[int] = None) -> dict:
+        if message_id is None:
+            self._message_id += 1
+            message_id = self._message_id
+        return {"message_id": message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": self.bot_id, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+
+    def _method_getMe(self, params: dict) -> dict:
+        return {"id": self.bot_id, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+    def _method_sendMessage(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        # Replies that finish a request carry the inline keyboard.
+        self._record(chat_id, text, final="reply_markup" in params, edit=False)
+        return self._message(chat_id, text)
+
+    def _method_editMessageText(self, params: dict) -> dict:
+        chat_id = int(params["chat_id"])
+        text = params.get("text", "")
+        self._record(chat_id, text, final="reply_markup" in params, edit=True)
+        return self._message(chat_id, text, int(params["message_id"]))
+
+    def _method_getFile(self, params: dict) -> dict:
+        file_id = params["file_id"]
+        data = self.files.get(file_id, b"")
+        return {"file_id": file_id, "file_unique_id": f"u-{file_id}", "file_size": len(data), "file_path": f"media/{file_id}"}
+
+    def stats(self) -> dict:
+        return {"methods": dict(self.method_counts), "downloaded_bytes": self.downloaded_bytes,
+                "flood_errors": self.flood_errors, "too_long_rejected": self.too_long}
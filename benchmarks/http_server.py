@@ -0,0 +1,123 @@
+"""Minimal asyncio HTTP/1.1 server used by the fake Gemini and Telegram APIs.
+
+It supports keep-alive, Content-Length and chunked request bodies, and both
+fixed and streamed (chunked) responses, which is all the bot's clients need.
+"""
+import asyncio
+import json
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Union
+from urllib.parse import urlsplit, parse_qs
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+class Request:
+    def __init__(self, method: str, target: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        parts = urlsplit(target)
+        self.path = parts.path
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body) if self.body else {}
+
+class Response:
+    def __init__(self, status: int = 200, body: Union[bytes, str, dict, None] = None,
+                 headers: Optional[Dict[str, str]] = None, stream: Optional[AsyncIterator[bytes]] = None):
+        self.status = status
+        self.headers = dict(headers or {})
+        if isinstance(body, dict):
+            body = json.dumps(body, ensure_ascii=False)
+            self.headers.setdefault("Content-Type", "application/json")
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.body = body or b""
+        self.stream = stream
+
+class ConnectionCut(Exception):
+    """Raise from a response stream to drop the connection mid-body."""
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+class MiniHTTPServer:
+    def __init__(self, handler: Handler, host: str = "127.0.0.1", port: int = 0):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, limit=1 << 20)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str]) -> bytes:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    await reader.readline()
+                    return b"".join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+        length = int(headers.get("content-length", 0))
+        return await reader.readexactly(length) if length else b""
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await self._read_body(reader, headers)
+                response = await self.handler(Request(method, target, headers, body))
+                if not await self._write(writer, response):
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write(self, writer: asyncio.StreamWriter, response: Response) -> bool:
+        head = [f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'Unknown')}"]
+        headers = dict(response.headers)
+        if response.stream is None:
+            headers["Content-Length"] = str(len(response.body))
+        else:
+            headers["Transfer-Encoding"] = "chunked"
+        head += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        if response.stream is None:
+            writer.write(response.body)
+            await writer.drain()
+            return True
+        try:
+            async for chunk in response.stream:
+                writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                await writer.drain()
+        except ConnectionCut:
+            # Simulated network failure: drop the connection without finishing the body.
+            writer.transport.abort()
+            return False
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
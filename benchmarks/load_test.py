@@ -0,0 +1,314 @@
+"""End-to-end load test of the bot against local fake Gemini and Telegram servers.
+
+Every virtual user is a private chat that sends ``--messages`` updates one after
+another (text, photo or voice, depending on ``--scenario``); updates are fed into
+the real Application built by ``main.build_application``, so the handlers, the
+update processor, the caches and the Gemini client all run exactly as in
+production. Run from the repository root:
+
+    python -m benchmarks.load_test --users 200 --messages 3 --scenario mixed --output run.json
+    python -m benchmarks.load_test --users 200 --messages 3 --scenario mixed --baseline run.json
+
+The JSON report includes the git commit so runs of different commits can be
+compared with ``--baseline``.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+from benchmarks.fake_gemini import FakeGeminiConfig, FakeGeminiServer
+from benchmarks.fake_telegram import FakeTelegramServer
+
+SCENARIOS = ("text", "image", "voice", "mixed")
+FAKE_TOKEN = "123456:load-test"
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return round(ordered[index], 4)
+
+def _summary(values: List[float]) -> dict:
+    return {
+        "mean": round(statistics.fmean(values), 4) if values else None,
+        "p50": _percentile(values, 0.50),
+        "p95": _percentile(values, 0.95),
+        "p99": _percentile(values, 0.99),
+        "max": round(max(values), 4) if values else None,
+    }
+
+def _peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.gemini = FakeGeminiServer(FakeGeminiConfig(
+            ttft=args.ttft, tokens_per_second=args.tokens_per_second, reply_tokens=args.reply_tokens,
+            fault_rate=args.fault_rate, quota_rate=args.quota_rate, cut_rate=args.cut_rate, seed=args.seed,
+            down_models=tuple(args.down_model), prefill_tokens_per_second=args.prefill_tokens_per_second,
+        ))
+        self.telegram = FakeTelegramServer(flood_rate=args.tg_flood_rate, seed=args.seed)
+        self.application = None
+        self.ttft: List[float] = []
+        self.latency: Dict[str, List[float]] = {scenario: [] for scenario in SCENARIOS[:-1]}
+        self.timeouts = 0
+        self._states: Dict[int, int] = {}
+        self._update_id = 0
+        self._message_id = 0
+
+    async def setup(self) -> None:
+        await self.gemini.start()
+        await self.telegram.start()
+        # Settings are read at import time, so the bot modules are imported only
+        # once the fake servers' addresses are known.
+        os.environ["GEMINI_BASE_URL"] = self.gemini.url
+        os.environ["GEMINI_API_KEY"] = "load-test"
+        os.environ["GEMINI_PROXY_URL"] = ""
+        os.environ["PERSISTENCE_BACKEND"] = self.args.persistence
+        from telegram import Update
+        from telegram.ext import Application, TypeHandler
+        import main
+
+        logging.getLogger().setLevel(self.args.log_level)
+        builder = (
+            Application.builder()
+            .token(FAKE_TOKEN)
+            .base_url(f"{self.telegram.url}/bot")
+            .base_file_url(f"{self.telegram.url}/file/bot")
+            .updater(None)
+        )
+        self.application = main.build_application(builder)
+        # Users reach the feature states through the inline menu; the load test skips
+        # the clicks and sets the state right before its update is handled, which
+        # keeps it ordered after the previous update of the same user.
+        self.application.add_handler(TypeHandler(Update, self._apply_state), group=-1)
+        self.post_shutdown = main.post_shutdown
+        await self.application.initialize()
+        await main.post_init(self.application)
+        await self.application.start()
+
+    async def teardown(self) -> None:
+        await self.application.stop()
+        # Same order as run_polling: the Application flushes its persistence before
+        # post_shutdown closes the store underneath it.
+        await self.application.shutdown()
+        await self.post_shutdown(self.application)
+        await self.telegram.stop()
+        await self.gemini.stop()
+
+    async def _apply_state(self, update, context) -> None:
+        state = self._states.pop(update.update_id, None)
+        if state is not None:
+            context.user_data["state"] = state
+
+    def _kind(self, user_id: int, index: int) -> str:
+        if self.args.scenario != "mixed":
+            return self.args.scenario
+        return SCENARIOS[(user_id + index) % 3]
+
+    def _media_id(self, kind: str, user_id: int, index: int) -> str:
+        # A share of the media is repeated across users to exercise the answer cache.
+        if self.rng.random() < self.args.repeat_rate:
+            return f"{kind}-shared"
+        return f"{kind}-{user_id}-{index}"
+
+    def _make_update(self, user_id: int, index: int, kind: str) -> dict:
+        from config.constants import States
+
+        self._update_id += 1
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        }
+        if kind == "text":
+            state = States.WAITING_FOR_TEXT
+            message["text"] = f"Вопрос {index} от пользователя {user_id}: расскажи что-нибудь интересное."
+        elif kind == "image":
+            state = States.WAITING_FOR_IMAGE
+            file_id = self._media_id("photo", user_id, index)
+            self.telegram.files.setdefault(file_id, os.urandom(self.args.photo_bytes))
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960,
+                                 "file_size": self.args.photo_bytes}]
+        else:
+            state = States.WAITING_FOR_VOICE
+            file_id = self._media_id("voice", user_id, index)
+            self.telegram.files.setdefault(file_id, os.urandom(self.args.voice_bytes))
+            message["voice"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 5,
+                                "mime_type": "audio/ogg", "file_size": self.args.voice_bytes}
+        self._states[self._update_id] = state
+        return {"update_id": self._update_id, "message": message}
+
+    async def run_user(self, user_id: int) -> None:
+        from telegram import Update
+
+        for index in range(self.args.messages):
+            kind = self._kind(user_id, index)
+            update = Update.de_json(self._make_update(user_id, index, kind), self.application.bot)
+            timeline = self.telegram.expect_reply(user_id)
+            sent_at = time.perf_counter()
+            await self.application.update_queue.put(update)
+            try:
+                await asyncio.wait_for(timeline.final_event.wait(), self.args.timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                continue
+            self.latency[kind].append(timeline.final_at - sent_at)
+            if timeline.first_text_at is not None:
+                self.ttft.append(timeline.first_text_at - sent_at)
+            if self.args.think_time:
+                await asyncio.sleep(self.rng.uniform(0, 2 * self.args.think_time))
+
+    async def run(self) -> dict:
+        await self.setup()
+        rss_before = _peak_rss_bytes()
+        started = time.perf_counter()
+        try:
+            users = range(1, self.args.users + 1)
+            if self.args.ramp_up:
+                async def delayed(user_id: int) -> None:
+                    await asyncio.sleep(self.args.ramp_up * user_id / self.args.users)
+                    await self.run_user(user_id)
+                await asyncio.gather(*(delayed(user_id) for user_id in users))
+            else:
+                await asyncio.gather(*(self.run_user(user_id) for user_id in users))
+            elapsed = time.perf_counter() - started
+            rss_after = _peak_rss_bytes()
+            return self._report(elapsed, rss_before, rss_after)
+        finally:
+            await self.teardown()
+
+    def _report(self, elapsed: float, rss_before: int, rss_after: int) -> dict:
+        bot_data = self.application.bot_data
+        gemini_stats = self.gemini.stats
+        all_latency = [value for values in self.latency.values() for value in values]
+        updates = self.args.users * self.args.messages
+        completed = len(all_latency)
+        return {
+            "commit": _git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": vars(self.args),
+            "results": {
+                "updates": updates,
+                "completed": completed,
+                "timeouts": self.timeouts,
+                "elapsed_seconds": round(elapsed, 3),
+                "throughput_updates_per_second": round(completed / elapsed, 2) if elapsed else None,
+                "ttft_seconds": _summary(self.ttft),
+                "latency_seconds": _summary(all_latency),
+                "latency_by_kind_seconds": {kind: _summary(values) for kind, values in self.latency.items() if values},
+                "upstream": {
+                    "generate_calls": gemini_stats.stream_requests,
+                    "generate_calls_per_update": round(gemini_stats.stream_requests / updates, 3) if updates else None,
+                    "upload_calls": gemini_stats.upload_requests,
+                    "faults_injected": gemini_stats.faults,
+                    "streams_cut": gemini_stats.cuts,
+                    "request_bytes": gemini_stats.request_bytes,
+                    "prompt_tokens": gemini_stats.prompt_tokens,
+                    "cached_tokens": gemini_stats.cached_tokens,
+                    "caches_created": gemini_stats.caches_created,
+                    "by_model": dict(gemini_stats.by_model),
+                },
+                "telegram": self.telegram.stats(),
+                "memory": {
+                    "peak_rss_bytes": rss_after,
+                    "peak_rss_growth_bytes": rss_after - rss_before,
+                    "peak_rss_growth_per_user_bytes": (rss_after - rss_before) // self.args.users,
+                },
+                "sessions": bot_data["gemini_service"].sessions.stats(),
+                "response_cache": bot_data["response_cache"].stats(),
+            },
+        }
+
+# Metrics compared with --baseline; for all of them lower is better except throughput.
+COMPARED = [
+    ("throughput_updates_per_second",),
+    ("ttft_seconds", "p50"),
+    ("ttft_seconds", "p95"),
+    ("latency_seconds", "p50"),
+    ("latency_seconds", "p95"),
+    ("latency_seconds", "p99"),
+    ("upstream", "generate_calls_per_update"),
+    ("upstream", "request_bytes"),
+    ("upstream", "prompt_tokens"),
+    ("memory", "peak_rss_growth_per_user_bytes"),
+]
+
+def _lookup(results: dict, path: tuple):
+    for key in path:
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+def compare(report: dict, baseline: dict) -> List[str]:
+    lines = [f"Compared with {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp')}):"]
+    for path in COMPARED:
+        old, new = _lookup(baseline["results"], path), _lookup(report["results"], path)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+        lines.append(f"  {'.'.join(path):<45} {old:>12} -> {new:<12} {change}")
+    return lines
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end load test with fake Gemini and Telegram servers")
+    parser.add_argument("--users", type=int, default=50, help="concurrent virtual users (private chats)")
+    parser.add_argument("--messages", type=int, default=3, help="updates sent by each user, one after another")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="text")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean pause between a reply and the next update")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="seconds over which users are started")
+    parser.add_argument("--repeat-rate", type=float, default=0.0, help="share of photos/voices reused across users")
+    parser.add_argument("--photo-bytes", type=int, default=200_000)
+    parser.add_argument("--voice-bytes", type=int, default=50_000)
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for each reply")
+    parser.add_argument("--ttft", type=float, default=0.3, help="fake Gemini time to first chunk")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--reply-tokens", type=int, default=120)
+    parser.add_argument("--fault-rate", type=float, default=0.0)
+    parser.add_argument("--quota-rate", type=float, default=0.0)
+    parser.add_argument("--cut-rate", type=float, default=0.0)
+    parser.add_argument("--down-model", action="append", default=[], help="fake Gemini model that always answers 503")
+    parser.add_argument("--prefill-tokens-per-second", type=float, default=0.0, help="fake Gemini prompt processing rate, 0 ignores prompt size")
+    parser.add_argument("--tg-flood-rate", type=float, default=0.0, help="share of Telegram sends answered with 429")
+    parser.add_argument("--persistence", choices=["none", "sqlite", "log"], default="none")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="JSON report of an earlier run to compare with")
+    args = parser.parse_args()
+
+    report = asyncio.run(LoadTest(args).run())
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+
+if __name__ == "__main__":
+    main()
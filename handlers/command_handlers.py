@@ -3,6 +3,7 @@ from telegram.ext import ContextTypes
 import json
 from config.constants import States, Buttons, ButtonText
 from utils.keyboard_utils import get_main_menu_keyboard, get_back_button_keyboard
+from services.metrics import MENU_SELECTIONS
 
 # Helper function to set user state
 def set_user_state(context: ContextTypes.DEFAULT_TYPE, state: int) -> None:
@@ -44,6 +45,7 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
 
     user_id = query.from_user.id
     data = query.data
+    MENU_SELECTIONS.inc(button=data)
 
     if data == Buttons.BACK_TO_MAIN_MENU:
         await main_menu(update, context)
@@ -2,12 +2,70 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from config.constants import States, Buttons
 from utils.keyboard_utils import get_main_menu_keyboard, get_back_button_keyboard
+from utils.stream_utils import reply_streaming, reply_long_text
+from utils.media_utils import download_media, prepare_photo
+from services.gemini_service import StreamOutcome, StreamRestarted
+from services.response_cache import ResponseCache, Computed, make_key, normalize_url, normalize_text
+from services.metrics import IN_FLIGHT, UPDATES, span, trace
+import asyncio
+import functools
 import json
+from typing import AsyncIterator, Union
+
+# Metric labels: the feature a user state belongs to, and readable state names
+FEATURES = {
+    States.MAIN_MENU: "menu",
+    States.WAITING_FOR_TEXT: "text",
+    States.WAITING_FOR_IMAGE: "image",
+    States.WAITING_FOR_VOICE: "voice",
+    States.WAITING_FOR_STRUCTURED_PROMPT: "structured_output",
+    States.WAITING_FOR_CODE: "code",
+    States.WAITING_FOR_URL: "url",
+    States.WAITING_FOR_SEARCH_QUERY: "search",
+}
+STATE_NAMES = {value: name.lower() for name, value in vars(States).items() if not name.startswith("_")}
+
+async def _fenced_json(deltas: AsyncIterator[Union[str, StreamRestarted]], outcome: StreamOutcome) -> AsyncIterator[Union[str, StreamRestarted]]:
+    # Shows the JSON as a code block while it streams. Error and safety notices are
+    # set on the outcome before they arrive, so they stay outside the block.
+    fenced = False
+    async for delta in deltas:
+        if isinstance(delta, StreamRestarted):
+            fenced = False
+            yield delta
+            continue
+        if not fenced and outcome.ok:
+            fenced = True
+            yield "```json\n"
+        elif fenced and not outcome.ok:
+            fenced = False
+            yield "\n```\n"
+        yield delta
+    if fenced:
+        yield "\n```"
 
 # Helper function to set user state (redefined here for clarity, can be moved to a common util if needed)
 def set_user_state(context: ContextTypes.DEFAULT_TYPE, state: int) -> None:
     context.user_data['state'] = state
 
+def instrumented(feature: str = ""):
+    """Count the update and time the handler as the ``handler`` stage.
+
+    Without an explicit ``feature`` the handler is labelled with the feature of the
+    user's current state.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            state = context.user_data.get('state', States.MAIN_MENU)
+            name = feature or FEATURES.get(state, "unknown")
+            UPDATES.inc(feature=name, state=STATE_NAMES.get(state, "unknown"))
+            with trace(name), IN_FLIGHT.track_inprogress(stage="handler"), span("handler"):
+                await handler(update, context)
+        return wrapper
+    return decorator
+
+@instrumented()
 async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     gemini_service = context.bot_data['gemini_service']
     user_id = update.effective_user.id
@@ -15,10 +73,15 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
     text = update.message.text
     response_text = ""
     reply_markup = None
+    replied = False
 
     if current_state == States.WAITING_FOR_TEXT:
-        response_text = await gemini_service.generate_text_response(user_id, text)
-        reply_markup = get_back_button_keyboard()
+        response_text = await reply_streaming(
+            update.message,
+            gemini_service.stream_text_response(user_id, text),
+            reply_markup=get_back_button_keyboard(),
+        )
+        replied = True
     elif current_state == States.WAITING_FOR_STRUCTURED_PROMPT:
         parts = text.split('\n', 1)
         if len(parts) < 2:
@@ -28,16 +91,27 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
             prompt_text = parts[0]
             try:
                 schema = json.loads(parts[1])
-                response_text = await gemini_service.generate_structured_output(user_id, prompt_text, schema)
-                response_text = f"```json\n{response_text}\n```"
-                reply_markup = get_back_button_keyboard()
             except json.JSONDecodeError:
                 response_text = "Неверный формат JSON схемы. Пожалуйста, убедитесь, что JSON корректен.\nФормат: `prompt`\n`{\"key\": \"value\"}`"
                 reply_markup = get_back_button_keyboard()
+            else:
+                outcome = StreamOutcome()
+                response_text = await reply_streaming(
+                    update.message,
+                    _fenced_json(gemini_service.stream_structured_output(user_id, prompt_text, schema, outcome=outcome), outcome),
+                    reply_markup=get_back_button_keyboard(),
+                    feature="structured_output",
+                )
+                replied = True
     elif current_state == States.WAITING_FOR_CODE:
         code = text
-        response_text = await gemini_service.execute_code(user_id, code, "Выполни следующий код Python:")
-        reply_markup = get_back_button_keyboard()
+        response_text = await reply_streaming(
+            update.message,
+            gemini_service.stream_code_execution(user_id, code, "Выполни следующий код Python:"),
+            reply_markup=get_back_button_keyboard(),
+            feature="code",
+        )
+        replied = True
     elif current_state == States.WAITING_FOR_URL:
         parts = text.split('\n', 1)
         url = parts[0]
@@ -46,13 +120,39 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
             response_text = "Пожалуйста, введите корректный URL, начинающийся с http:// или https://.\nФормат: `URL`\n`[prompt]`"
             reply_markup = get_back_button_keyboard()
         else:
-            response_text = await gemini_service.analyze_url_context(user_id, url, prompt_text)
+            async def analyze_url() -> Computed:
+                outcome = StreamOutcome()
+                result = await reply_streaming(
+                    update.message,
+                    gemini_service.stream_url_context(user_id, url, prompt_text, outcome=outcome),
+                    reply_markup=get_back_button_keyboard(),
+                    feature="url",
+                )
+                return Computed(result, cacheable=outcome.ok)
+
+            key = make_key("url", gemini_service.model_name, normalize_url(url), prompt_text.strip())
+            response_text, status = await context.bot_data['response_cache'].get_or_create(key, analyze_url)
+            # A miss was already streamed to the user by the factory.
+            replied = status == ResponseCache.MISS
             reply_markup = get_back_button_keyboard()
     elif current_state == States.WAITING_FOR_SEARCH_QUERY:
         parts = text.split('\n', 1)
         query = parts[0]
         prompt_text = parts[1] if len(parts) > 1 else "Найди информацию по этому запросу."
-        response_text = await gemini_service.perform_google_search(user_id, query, prompt_text)
+
+        async def search() -> Computed:
+            outcome = StreamOutcome()
+            result = await reply_streaming(
+                update.message,
+                gemini_service.stream_google_search(user_id, query, prompt_text, outcome=outcome),
+                reply_markup=get_back_button_keyboard(),
+                feature="search",
+            )
+            return Computed(result, cacheable=outcome.ok)
+
+        key = make_key("search", gemini_service.model_name, normalize_text(query), prompt_text.strip())
+        response_text, status = await context.bot_data['response_cache'].get_or_create(key, search)
+        replied = status == ResponseCache.MISS
         reply_markup = get_back_button_keyboard()
     elif current_state == States.MAIN_MENU:
         response_text = "Пожалуйста, выберите действие из меню ниже или используйте команду /help."
@@ -61,38 +161,126 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
         response_text = "Неизвестное состояние. Пожалуйста, выберите действие из меню или используйте команду /help."
         reply_markup = get_main_menu_keyboard()
 
-    await update.message.reply_text(response_text, reply_markup=reply_markup)
+    if not replied:
+        await reply_long_text(update.message, response_text, reply_markup=reply_markup)
     if current_state != States.MAIN_MENU: # Only reset state if it was not main menu already
         set_user_state(context, States.MAIN_MENU)
 
+async def _handle_album(update: Update, context: ContextTypes.DEFAULT_TYPE, group_key: tuple, state: int) -> None:
+    with trace("album"), IN_FLIGHT.track_inprogress(stage="handler"), span("handler"):
+        await _answer_album(update, context, group_key, state)
+
+async def _answer_album(update: Update, context: ContextTypes.DEFAULT_TYPE, group_key: tuple, state: int) -> None:
+    messages = await context.bot_data['media_groups'].wait(group_key)
+    if state != States.WAITING_FOR_IMAGE:
+        await update.message.reply_text("Пожалуйста, выберите 'Понимание изображений' из меню, чтобы отправить изображение.", reply_markup=get_main_menu_keyboard())
+        return
+
+    gemini_service = context.bot_data['gemini_service']
+    user_id = update.effective_user.id
+    messages.sort(key=lambda message: message.message_id)
+    photos = [message.photo[-1] for message in messages]
+    caption = "\n".join(message.caption for message in messages if message.caption)
+
+    async def describe_album() -> Computed:
+        results = await asyncio.gather(
+            *[download_media(context.bot, photo.file_id, "image/jpeg", photo.file_size) for photo in photos],
+            return_exceptions=True,
+        )
+        media = [result for result in results if not isinstance(result, BaseException)]
+        try:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            downloaded = sum(item.size for item in media)
+            media = list(await asyncio.gather(*[prepare_photo(item) for item in media]))
+            outcome = StreamOutcome()
+            result = await reply_streaming(
+                update.message,
+                gemini_service.stream_response_with_images(user_id, caption, media, outcome=outcome),
+                reply_markup=get_back_button_keyboard(),
+                feature="album",
+            )
+        finally:
+            for item in media:
+                item.cleanup()
+        return Computed(result, cacheable=outcome.ok, upstream_bytes=downloaded)
+
+    key = make_key("album", gemini_service.model_name, *[photo.file_unique_id for photo in photos], caption.strip())
+    response, status = await context.bot_data['response_cache'].get_or_create(key, describe_album)
+    if status != ResponseCache.MISS:
+        await reply_long_text(update.message, response, reply_markup=get_back_button_keyboard())
+
+@instrumented("image")
 async def handle_image_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     gemini_service = context.bot_data['gemini_service']
     user_id = update.effective_user.id
     current_state = context.user_data.get('state', States.MAIN_MENU)
 
+    if update.message.media_group_id is not None:
+        # Albums arrive as one update per photo; the first one answers for the whole album.
+        collector = context.bot_data['media_groups']
+        group_key = (user_id, update.message.media_group_id)
+        if not collector.add(group_key, update.message):
+            collector.start(group_key, update.message)
+            # Reset the state now, while this user's updates are still in order: the
+            # album is answered in the background, and a menu choice made meanwhile
+            # must not be overwritten when it finishes.
+            set_user_state(context, States.MAIN_MENU)
+            # Run in the background so this user's queue keeps delivering the other photos.
+            context.application.create_task(_handle_album(update, context, group_key, current_state), update=update)
+        return
+
     if current_state == States.WAITING_FOR_IMAGE:
-        photo_file = await context.bot.get_file(update.message.photo[-1].file_id)
-        photo_data = await photo_file.download_as_bytearray()
-        
+        photo = update.message.photo[-1]
         caption = update.message.caption or ""
-        response = await gemini_service.generate_response_with_image(user_id, caption, bytes(photo_data))
-        await update.message.reply_text(response, reply_markup=get_back_button_keyboard())
+
+        async def describe_photo() -> Computed:
+            # Only runs on a cache miss, so repeated images skip the download entirely.
+            media = await download_media(context.bot, photo.file_id, "image/jpeg", photo.file_size)
+            downloaded = media.size
+            try:
+                media = await prepare_photo(media)
+                outcome = StreamOutcome()
+                result = await reply_streaming(
+                    update.message,
+                    gemini_service.stream_response_with_image(user_id, caption, media, outcome=outcome),
+                    reply_markup=get_back_button_keyboard(),
+                    feature="image",
+                )
+            finally:
+                media.cleanup()
+            return Computed(result, cacheable=outcome.ok, upstream_bytes=downloaded)
+
+        key = make_key("image", gemini_service.model_name, photo.file_unique_id, caption.strip())
+        response, status = await context.bot_data['response_cache'].get_or_create(key, describe_photo)
+        if status != ResponseCache.MISS:
+            await reply_long_text(update.message, response, reply_markup=get_back_button_keyboard())
         set_user_state(context, States.MAIN_MENU)
     else:
         await update.message.reply_text("Пожалуйста, выберите 'Понимание изображений' из меню, чтобы отправить изображение.", reply_markup=get_main_menu_keyboard())
 
+@instrumented("voice")
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     gemini_service = context.bot_data['gemini_service']
     user_id = update.effective_user.id
     current_state = context.user_data.get('state', States.MAIN_MENU)
 
     if current_state == States.WAITING_FOR_VOICE:
-        voice_file = await context.bot.get_file(update.message.voice.file_id)
-        voice_data = await voice_file.download_as_bytearray()
-        
+        voice = update.message.voice
+        # Telegram voice messages are OGG/Opus
+        media = await download_media(context.bot, voice.file_id, voice.mime_type or "audio/ogg", voice.file_size)
+
         caption = update.message.caption or ""
-        response = await gemini_service.generate_response_with_audio(user_id, caption, bytes(voice_data))
-        await update.message.reply_text(response, reply_markup=get_back_button_keyboard())
+        try:
+            await reply_streaming(
+                update.message,
+                gemini_service.stream_response_with_audio(user_id, caption, media),
+                reply_markup=get_back_button_keyboard(),
+                feature="voice",
+            )
+        finally:
+            media.cleanup()
         set_user_state(context, States.MAIN_MENU)
     else:
         await update.message.reply_text("Пожалуйста, выберите 'Обработка голоса' из меню, чтобы отправить голосовое сообщение.", reply_markup=get_main_menu_keyboard())
\ No newline at end of file
@@ -1,9 +1,42 @@
 import logging
 import os
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
+from typing import Optional
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 
-from config.settings import TELEGRAM_BOT_TOKEN, GEMINI_API_KEY
+from config.settings import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_API_URL,
+    GEMINI_API_KEY,
+    PERSISTENCE_BACKEND,
+    PERSISTENCE_PATH,
+    PERSISTENCE_FLUSH_INTERVAL,
+    PERSISTENCE_BATCH_SIZE,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_MAX_BYTES,
+    RESPONSE_CACHE_TTL,
+    UPDATE_MAX_CONCURRENT,
+    UPDATE_MAX_QUEUED,
+    UPDATE_MAX_QUEUED_PER_USER,
+    MEDIA_GROUP_WINDOW,
+    METRICS_PORT,
+    METRICS_HOST,
+    METRICS_TRACE,
+    METRICS_TRACE_MIN_SECONDS,
+    WEBHOOK_URL,
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE,
+    TELEGRAM_SEND_MAX_RETRIES,
+)
 from services.gemini_service import GeminiService
+from services.session_store import create_session_store, WriteBehindWriter
+from services.bot_persistence import StoreBackedPersistence
+from services.response_cache import ResponseCache
+from services.update_processor import FairUpdateProcessor
+from services.rate_limiter import FloodControlRateLimiter
+from services.metrics import REGISTRY, MetricsServer, configure_tracing, stats_collector
+from utils.media_group_utils import MediaGroupCollector
 from handlers.command_handlers import (
     start,
     help_command,
@@ -23,17 +56,102 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def main() -> None:
-    """Start the bot."""
+async def post_init(application: Application) -> None:
+    await application.bot_data['gemini_service'].start()
+    metrics_port = application.bot_data['metrics_port']
+    if metrics_port:
+        application.bot_data['metrics_server'] = MetricsServer(METRICS_HOST, metrics_port)
+        await application.bot_data['metrics_server'].start()
+
+async def post_shutdown(application: Application) -> None:
+    await application.bot_data['gemini_service'].close()
+    if 'metrics_server' in application.bot_data:
+        await application.bot_data.pop('metrics_server').stop()
+
+def register_metrics(application: Application) -> None:
+    """Export the counters the services already keep, read on every scrape."""
+    bot_data = application.bot_data
+    REGISTRY.register_collector(stats_collector(
+        "bot_response_cache", "Response cache", bot_data['response_cache'].stats))
+    REGISTRY.register_collector(stats_collector(
+        "bot_sessions", "Chat sessions", bot_data['gemini_service'].sessions.stats))
+    REGISTRY.register_collector(bot_data['gemini_service'].router.collect)
+    context_cache = bot_data['gemini_service'].context_cache
+    if context_cache is not None:
+        REGISTRY.register_collector(stats_collector("gemini_context_cache", "Cached conversation prefixes", context_cache.stats))
+    if isinstance(application.update_processor, FairUpdateProcessor):
+        REGISTRY.register_collector(stats_collector(
+            "bot_update_processor", "Update processor", application.update_processor.stats))
+    if isinstance(application.bot.rate_limiter, FloodControlRateLimiter):
+        REGISTRY.register_collector(stats_collector(
+            "bot_rate_limiter", "Outgoing flood control", application.bot.rate_limiter.stats))
+    store_writer = bot_data['gemini_service'].store_writer
+    if store_writer is not None:
+        REGISTRY.register_collector(stats_collector("bot_persistence", "Write-behind writer", store_writer.stats))
+
+def default_builder() -> ApplicationBuilder:
+    return (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    )
+
+def build_application(application_builder: Optional[ApplicationBuilder] = None, metrics_port: int = METRICS_PORT,
+                      worker: int = 0, workers: int = 1) -> Application:
+    """Create the Application with all services and handlers attached.
+
+    ``application_builder`` lets callers such as the benchmarks or the webhook
+    workers configure the Bot API connection; by default the configured token is
+    used. ``metrics_port`` is where this process serves /metrics, 0 disables it.
+    ``worker`` is this process's index among ``workers`` processes that share the
+    bot's quotas in webhook mode.
+    """
+    # Optional persistent storage for chat sessions and user state. SQLite handles
+    # several processes on one file; the append-only log does not, so each webhook
+    # worker keeps a log of its own users.
+    persistence_path = PERSISTENCE_PATH
+    if PERSISTENCE_BACKEND == "log" and workers > 1:
+        persistence_path = f"{PERSISTENCE_PATH}.{worker}"
+    store = create_session_store(PERSISTENCE_BACKEND, persistence_path)
+    store_writer = WriteBehindWriter(store, PERSISTENCE_FLUSH_INTERVAL, PERSISTENCE_BATCH_SIZE) if store else None
+
     # Initialize GeminiService
-    gemini_service = GeminiService()
+    gemini_service = GeminiService(store_writer=store_writer, workers=workers)
 
-    application_builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+    if application_builder is None:
+        application_builder = default_builder()
+    application_builder = (
+        application_builder
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(
+            FairUpdateProcessor(UPDATE_MAX_CONCURRENT, UPDATE_MAX_QUEUED, UPDATE_MAX_QUEUED_PER_USER)
+        )
+        .rate_limiter(
+            # The overall limit is per bot token, so the workers share it.
+            FloodControlRateLimiter(
+                TELEGRAM_GLOBAL_RATE / workers, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST,
+                TELEGRAM_GROUP_RATE, TELEGRAM_SEND_MAX_RETRIES,
+            )
+        )
+    )
+    if store_writer is not None:
+        application_builder = application_builder.persistence(
+            StoreBackedPersistence(store_writer, update_interval=PERSISTENCE_FLUSH_INTERVAL)
+        )
 
     application = application_builder.build()
 
     # Store gemini_service in bot_data so handlers can access it
     application.bot_data['gemini_service'] = gemini_service
+    application.bot_data['response_cache'] = ResponseCache(
+        RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL
+    )
+    application.bot_data['media_groups'] = MediaGroupCollector(MEDIA_GROUP_WINDOW)
+    application.bot_data['metrics_port'] = metrics_port
+    configure_tracing(METRICS_TRACE, METRICS_TRACE_MIN_SECONDS)
+    register_metrics(application)
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
@@ -47,6 +165,17 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_all_messages))
     application.add_handler(MessageHandler(filters.VOICE, handle_voice_message))
     application.add_handler(MessageHandler(filters.PHOTO, handle_image_message))
+    return application
+
+def main() -> None:
+    """Start the bot."""
+    if WEBHOOK_URL:
+        # Receiver process plus one worker process per core, sharded by user id
+        from services.webhook_workers import run_webhook
+        run_webhook()
+        return
+
+    application = build_application()
 
     # Run the bot until the user presses Ctrl-C
     application.run_polling()
@@ -1,6 +1,7 @@
 class Prompts:
     TEXT_GENERATION_PROMPT = "Ты - полезный ассистент. Отвечай на вопросы пользователя максимально полно и точно."
     IMAGE_UNDERSTANDING_PROMPT = "Опиши, что изображено на картинке. Будь максимально подробным."
+    ALBUM_UNDERSTANDING_PROMPT = "Опиши, что изображено на каждой из картинок, и что их объединяет. Будь максимально подробным."
     VIDEO_UNDERSTANDING_PROMPT = "Опиши содержание видео. Укажи ключевые моменты и действия."
     AUDIO_UNDERSTANDING_PROMPT = "Проанализируй аудиозапись и предоставь краткое содержание или транскрипцию, если это возможно."
     STRUCTURED_OUTPUT_PROMPT = "Сгенерируй ответ в формате JSON, содержащий следующую информацию: {fields}."
@@ -10,5 +11,11 @@ class Prompts:
     URL_CONTEXT_PROMPT = "Проанализируй содержимое по указанному URL и ответь на вопрос пользователя."
     GOOGLE_SEARCH_PROMPT = "Используй Google Search для поиска информации по запросу пользователя и предоставь краткое резюме результатов."
     LONG_CONTEXT_PROMPT = "Ответь на вопрос, используя весь предоставленный контекст. Будь внимателен к деталям."
+    SUMMARY_PROMPT = (
+        "Обнови краткое содержание диалога. Сохрани факты, договоренности и предпочтения пользователя.\n\n"
+        "Текущее содержание:\n{summary}\n\nНовые реплики:\n{transcript}"
+    )
+    CONTINUE_PROMPT = "Твой ответ прервался. Продолжи его ровно с того места, где он оборвался, ничего не повторяя."
+    SUMMARY_CONTEXT_PROMPT = "Краткое содержание предыдущей части диалога:\n{summary}"
     # Placeholder for other potential prompts
     DEFAULT_PROMPT = "Ты - полезный ассистент."
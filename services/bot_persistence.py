@@ -0,0 +1,79 @@
+from typing import Dict, Optional, Set
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._utils.types import ConversationDict, ConversationKey, CDCData
+from services.session_store import WriteBehindWriter, USER_DATA
+
+class StoreBackedPersistence(BasePersistence):
+    """python-telegram-bot persistence for ``user_data`` backed by a session store.
+
+    Nothing is read at startup: each user's data is loaded the first time an
+    update from them is processed (via ``refresh_user_data``), and changes go
+    through the same write-behind queue as chat sessions.
+    """
+
+    def __init__(self, writer: WriteBehindWriter, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.writer = writer
+        self._loaded_users: Set[int] = set()
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        stored = await self.writer.load(USER_DATA, user_id)
+        if stored:
+            # Values set by this process since startup win over the stored ones.
+            for key, value in stored.items():
+                user_data.setdefault(key, value)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._loaded_users.add(user_id)
+        self.writer.put(USER_DATA, user_id, dict(data))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._loaded_users.discard(user_id)
+        self.writer.put(USER_DATA, user_id, None)
+
+    async def flush(self) -> None:
+        await self.writer.flush()
+
+    # Only user_data is persisted; the remaining hooks are no-ops.
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self) -> Optional[CDCData]:
+        return None
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        return {}
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data: CDCData) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, Set, Tuple
+import httpx
+from prompts.base_prompts import Prompts
+from services.media import dumps
+from services.request_templates import RequestTemplate
+from services.session_manager import ChatSession, estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class CachedPrefix:
+    """A Gemini cachedContents resource holding the first ``length`` contents of a session."""
+    name: str
+    model: str
+    length: int
+    messages: Tuple[dict, ...]
+    summary: str
+    tokens: int
+    expires_at: float
+    valid: bool = True
+
+    def matches(self, session: ChatSession) -> bool:
+        # The cache only applies while the session still starts with exactly these
+        # messages; trimming or a new summary changes the start.
+        if session.summary != self.summary or len(session.messages) <= len(self.messages):
+            return False
+        return all(cached is current for cached, current in zip(self.messages, session.messages))
+
+class ContextCache:
+    """Moves the stable start of long conversations into Gemini cached contents.
+
+    Once a session's history reaches ``min_tokens`` it is cached on the server after
+    the turn, in the background, and later requests only send what came after it.
+    The cache is rebuilt when ``refresh_tokens`` of new history have piled up or
+    when the session no longer starts with the cached messages, and its TTL is
+    renewed while it is in use. Failing to create caches (e.g. on a plan without
+    context caching) pauses caching for a while instead of slowing every turn.
+    """
+
+    # How long caching stays off after the API refused to create a cache.
+    DISABLE_AFTER_ERROR = 600.0
+    # A cache this close to expiring is not used for a request any more.
+    EXPIRY_MARGIN = 10.0
+
+    def __init__(self, get_client: Callable[[], httpx.AsyncClient], api_root: str, api_key: str,
+                 template: RequestTemplate, min_tokens: int, refresh_tokens: int, ttl: int):
+        self.get_client = get_client
+        self.api_root = api_root
+        self.api_key = api_key
+        self.template = template
+        self.min_tokens = min_tokens
+        self.refresh_tokens = refresh_tokens
+        self.ttl = ttl
+        self._prefix_tokens = estimate_tokens({"parts": [{"text": template.system_prompt or ""}]})
+        self._entries: Dict[int, CachedPrefix] = {}
+        self._pending: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._disabled_until = 0.0
+        self._pruned_at = time.monotonic()
+        self.hits = 0
+        self.created = 0
+        self.renewed = 0
+        self.deleted = 0
+        self.failures = 0
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def lookup(self, user_id: int, session: ChatSession) -> Optional[CachedPrefix]:
+        """The cache to use for the session's next request, if one still applies."""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if not entry.valid or entry.expires_at - now < self.EXPIRY_MARGIN or not entry.matches(session):
+            self._drop(user_id)
+            return None
+        if entry.expires_at - now < self.ttl / 2:
+            entry.expires_at = now + self.ttl
+            self._spawn(self._renew(entry))
+        self.hits += 1
+        return entry
+
+    def update(self, user_id: int, session: ChatSession, model: str) -> None:
+        """Cache the session's history after a turn if it is long enough to pay off."""
+        now = time.monotonic()
+        if now - self._pruned_at > self.EXPIRY_MARGIN * 6:
+            self._prune(now)
+        if user_id in self._pending or now < self._disabled_until:
+            return
+        tokens = self._prefix_tokens + session.size_tokens
+        if tokens < self.min_tokens:
+            return
+        entry = self._entries.get(user_id)
+        if entry is not None and entry.valid and entry.model == model and entry.matches(session) \
+                and tokens - entry.tokens < self.refresh_tokens:
+            return
+        self._pending.add(user_id)
+        contents = session.contents(Prompts.SUMMARY_CONTEXT_PROMPT)
+        self._spawn(self._create(user_id, contents, tuple(session.messages), session.summary, model, tokens))
+
+    def invalidate(self, user_id: int) -> None:
+        self._drop(user_id)
+
+    def _prune(self, now: float) -> None:
+        # Entries of sessions that went quiet expire on the server by themselves.
+        self._pruned_at = now
+        for user_id, entry in list(self._entries.items()):
+            if entry.expires_at < now:
+                del self._entries[user_id]
+
+    def _drop(self, user_id: int) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None and entry.valid:
+            self._spawn(self._delete(entry))
+
+    async def _create(self, user_id: int, contents: list, messages: Tuple[dict, ...], summary: str,
+                      model: str, tokens: int) -> None:
+        body = {"model": f"models/{model}", "contents": contents, "ttl": f"{self.ttl}s", **self.template.cached_members}
+        try:
+            response = await self.get_client().post(
+                f"{self.api_root}/v1beta/cachedContents",
+                params={"key": self.api_key},
+                content=dumps(body),
+                headers={"Content-Type": "application/json"},
+            )
+            response.raise_for_status()
+            name = response.json()["name"]
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            self.failures += 1
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                self._disabled_until = time.monotonic() + self.DISABLE_AFTER_ERROR
+            logger.warning("Could not cache conversation of user %s: %s", user_id, e)
+            return
+        finally:
+            self._pending.discard(user_id)
+
+        self.created += 1
+        self._drop(user_id)
+        self._entries[user_id] = CachedPrefix(
+            name=name, model=model, length=len(contents), messages=messages, summary=summary,
+            tokens=tokens, expires_at=time.monotonic() + self.ttl,
+        )
+        logger.debug("Cached %d messages (~%d tokens) of user %s as %s", len(messages), tokens, user_id, name)
+
+    async def _renew(self, entry: CachedPrefix) -> None:
+        try:
+            response = await self.get_client().patch(
+                f"{self.api_root}/v1beta/{entry.name}",
+                params={"key": self.api_key, "updateMask": "ttl"},
+                json={"ttl": f"{self.ttl}s"},
+            )
+            response.raise_for_status()
+            self.renewed += 1
+        except httpx.HTTPError as e:
+            entry.valid = False
+            logger.warning("Could not renew cached content %s: %s", entry.name, e)
+
+    async def _delete(self, entry: CachedPrefix) -> None:
+        # Deleting stops storage billing right away; a cache that is left behind
+        # still expires after its TTL.
+        try:
+            response = await self.get_client().delete(f"{self.api_root}/v1beta/{entry.name}", params={"key": self.api_key})
+            if response.status_code != 404:
+                response.raise_for_status()
+            self.deleted += 1
+        except httpx.HTTPError as e:
+            logger.debug("Could not delete cached content %s: %s", entry.name, e)
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "cached_tokens": sum(entry.tokens for entry in self._entries.values()),
+            "hits": self.hits,
+            "created": self.created,
+            "renewed": self.renewed,
+            "deleted": self.deleted,
+            "failures": self.failures,
+        }
@@ -0,0 +1,104 @@
+import asyncio
+import base64
+import json
+import os
+import uuid
+from typing import AsyncIterator, Callable, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # listed in requirements.txt; the standard json module is the fallback
+    orjson = None
+
+# Raw bytes per base64 chunk; a multiple of 3 so chunks encode without padding.
+BASE64_CHUNK = 3 * 64 * 1024
+
+class MediaPayload:
+    """A media file to send to Gemini, held either in memory or in a file on disk.
+
+    The data is never copied: in-memory buffers are sliced through a memoryview and
+    files are read in chunks, so a request holds about one copy of the media.
+    """
+
+    def __init__(self, mime_type: str, data: Union[bytes, bytearray, memoryview, None] = None,
+                 path: Optional[str] = None, delete_file: bool = False):
+        if (data is None) == (path is None):
+            raise ValueError("Exactly one of data or path must be given")
+        self.mime_type = mime_type
+        self.data = memoryview(data) if data is not None else None
+        self.path = path
+        self.delete_file = delete_file
+        self.size = len(self.data) if self.data is not None else os.path.getsize(path)
+
+    async def iter_chunks(self, chunk_size: int, offset: int = 0) -> AsyncIterator[memoryview]:
+        if self.data is not None:
+            for start in range(offset, self.size, chunk_size):
+                yield self.data[start:start + chunk_size]
+            return
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    return
+                yield memoryview(chunk)
+
+    async def iter_base64(self) -> AsyncIterator[bytes]:
+        async for chunk in self.iter_chunks(BASE64_CHUNK):
+            yield base64.b64encode(chunk)
+
+    def cleanup(self) -> None:
+        self.data = None
+        if self.path and self.delete_file:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+def dumps(value, default: Optional[Callable] = None) -> bytes:
+    """Compact UTF-8 JSON, through orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(value, default=default)
+    return json.dumps(value, default=default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def encode_request_body(json_data: dict, static: bytes = b"") -> Tuple[Optional[bytes], Optional[Callable[[], AsyncIterator[bytes]]]]:
+    """Serialize a request, streaming any :class:`MediaPayload` as base64.
+
+    ``static`` holds further top-level members that were serialized in advance
+    (``"key":value,...`` without braces) and is spliced in as is.
+
+    Returns ``(body, None)`` for plain requests, or ``(None, factory)`` where
+    ``factory()`` produces a fresh async iterator over the body for every attempt.
+    """
+    payloads: List[MediaPayload] = []
+    marker = f"@@media-{uuid.uuid4().hex}-"
+
+    def default(obj):
+        if isinstance(obj, MediaPayload):
+            payloads.append(obj)
+            return f"{marker}{len(payloads) - 1}"
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    body = dumps(json_data, default=default)
+    if static:
+        body = b"".join((memoryview(body)[:-1], b"," if len(body) > 2 else b"", static, b"}"))
+    if not payloads:
+        return body, None
+
+    # Alternating JSON fragments and payload indexes: ['{..."data": "', '0', '"}...'].
+    pieces = body.split(marker.encode("ascii"))
+    fragments = [pieces[0]]
+    order = []
+    for piece in pieces[1:]:
+        index, _, rest = piece.partition(b'"')
+        order.append(payloads[int(index)])
+        fragments.append(b'"' + rest)
+
+    async def stream() -> AsyncIterator[bytes]:
+        yield fragments[0]
+        for payload, fragment in zip(order, fragments[1:]):
+            async for chunk in payload.iter_base64():
+                yield chunk
+            yield fragment
+
+    return None, stream
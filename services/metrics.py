@@ -0,0 +1,300 @@
+"""In-process metrics with a Prometheus text-format endpoint.
+
+Recording a sample is a dict update under the GIL, so instrumentation on the hot
+path costs next to nothing; all formatting happens only when ``/metrics`` is
+scraped. Components that already keep their own counters (caches, sessions, the
+update processor) are exported through collectors that are read at scrape time.
+"""
+import asyncio
+import bisect
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [bucket counts..., +Inf count], sum
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, **labels) -> int:
+        series = self._values.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+# A collector returns {metric name: (documentation, {labels tuple: value})} read at scrape time.
+Collector = Callable[[], Dict[str, Tuple[str, Dict[Tuple[Tuple[str, str], ...], float]]]]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Collector] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Collector) -> None:
+        self._collectors.append(collector)
+
+    def unregister_collector(self, collector: Collector) -> None:
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                collected = collector()
+            except Exception:
+                logger.exception("Metrics collector %r failed", collector)
+                continue
+            for name, (documentation, samples) in collected.items():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, sample in samples.items():
+                    names = [label for label, _ in labels]
+                    values = [value for _, value in labels]
+                    lines.append(f"{name}{_format_labels(names, values)} {_format_value(sample)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+def stats_collector(prefix: str, documentation: str, stats: Callable[[], dict]) -> Collector:
+    """Export every numeric value of a ``stats()`` dict as ``<prefix>_<key>``."""
+    def collect():
+        return {
+            f"{prefix}_{key}": (f"{documentation}: {key}", {(): value})
+            for key, value in stats().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+    return collect
+
+# Metrics shared by the handlers and the Gemini client
+STAGE_SECONDS = REGISTRY.histogram(
+    "bot_stage_duration_seconds", "Time spent in each stage of handling an update", ["stage", "feature"])
+UPDATES = REGISTRY.counter(
+    "bot_updates_total", "Updates handled per feature and user state", ["feature", "state"])
+IN_FLIGHT = REGISTRY.gauge(
+    "bot_in_flight", "Operations currently in progress", ["stage"])
+PAYLOAD_BYTES = REGISTRY.histogram(
+    "bot_payload_bytes", "Size of media downloads, request bodies and replies", ["kind"], SIZE_BUCKETS)
+MENU_SELECTIONS = REGISTRY.counter(
+    "bot_menu_selections_total", "Inline menu buttons pressed", ["button"])
+GEMINI_REQUESTS = REGISTRY.counter(
+    "gemini_requests_total", "Gemini API calls by result", ["model", "result"])
+GEMINI_RETRIES = REGISTRY.counter(
+    "gemini_retries_total", "Gemini API retries by cause", ["reason"])
+GEMINI_TOKENS = REGISTRY.counter(
+    "gemini_tokens_total", "Tokens reported in Gemini usageMetadata", ["model", "feature", "direction"])
+GEMINI_ROUTES = REGISTRY.counter(
+    "gemini_route_decisions_total", "Model chosen first for a request and why", ["feature", "model", "reason"])
+GEMINI_FALLBACKS = REGISTRY.counter(
+    "gemini_fallbacks_total", "Requests moved to another model after a failure", ["from_model", "to_model", "reason"])
+GEMINI_MODEL_SECONDS = REGISTRY.histogram(
+    "gemini_model_duration_seconds", "Duration of successful Gemini streams per model", ["model", "feature"])
+
+# Per-request traces: spans of one update are collected and logged together.
+class Trace:
+    __slots__ = ("name", "started", "spans")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: List[Tuple[str, float, float]] = []
+
+    def format(self) -> str:
+        spans = " ".join(f"{stage}@{start - self.started:.3f}+{duration:.3f}s" for stage, start, duration in self.spans)
+        return f"{self.name} total={time.perf_counter() - self.started:.3f}s {spans}"
+
+_current_feature: contextvars.ContextVar[str] = contextvars.ContextVar("metrics_feature", default="")
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("metrics_trace", default=None)
+_tracing = {"enabled": False, "min_seconds": 0.0}
+
+def configure_tracing(enabled: bool, min_seconds: float = 0.0) -> None:
+    _tracing["enabled"] = enabled
+    _tracing["min_seconds"] = min_seconds
+
+@contextmanager
+def trace(feature: str) -> Iterator[Optional[Trace]]:
+    """Label the stages recorded inside the block with ``feature``.
+
+    With tracing enabled the spans are also collected and logged as one line when
+    the block ends.
+    """
+    feature_token = _current_feature.set(feature)
+    current = Trace(feature) if _tracing["enabled"] else None
+    trace_token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(trace_token)
+        _current_feature.reset(feature_token)
+        if current is not None and time.perf_counter() - current.started >= _tracing["min_seconds"]:
+            logger.info("trace %s", current.format())
+
+def record_span(stage: str, started: float, duration: float) -> None:
+    STAGE_SECONDS.observe(duration, stage=stage, feature=_current_feature.get())
+    current = _current_trace.get()
+    if current is not None:
+        current.spans.append((stage, started, duration))
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """Time a block as one stage of the current feature; also added to its trace."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, started, time.perf_counter() - started)
+
+class MetricsServer:
+    """Serves ``GET /metrics`` in the Prometheus text format."""
+
+    def __init__(self, host: str, port: int, registry: MetricsRegistry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Metrics available on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.registry.render().encode("utf-8")
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                status, body, content_type = "404 Not Found", b"Not Found\n", "text/plain"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
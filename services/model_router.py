@@ -0,0 +1,141 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+from services.resilience import CircuitBreaker, LatencyTracker
+
+def parse_model_map(value: str) -> Dict[str, str]:
+    """Parse ``feature=model,feature=model`` into a dict."""
+    routes = {}
+    for item in value.split(","):
+        feature, _, model = item.partition("=")
+        if feature.strip() and model.strip():
+            routes[feature.strip()] = model.strip()
+    return routes
+
+class ModelHealth:
+    """Live signals about one model: its circuit, recent error rate and latency."""
+
+    # Weight of the newest call in the error rate; about the last 20 calls count.
+    ERROR_ALPHA = 0.05
+
+    def __init__(self, breaker_failures: int, breaker_reset: float):
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.latency = LatencyTracker(size=200, min_samples=20, refresh_every=10)
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        self.requests += 1
+        if not ok:
+            self.failures += 1
+        self.error_rate += self.ERROR_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if latency is not None:
+            self.latency.record(latency)
+
+    def available(self, max_error_rate: float) -> bool:
+        if self.breaker.rejecting:
+            return False
+        return max_error_rate <= 0 or self.error_rate < max_error_rate
+
+@dataclass
+class Route:
+    """Models to try for one request, in order, and why the first one was picked."""
+    models: List[str]
+    reason: str
+
+class ModelRouter:
+    """Picks the Gemini model for each request.
+
+    The feature decides the preferred model (``feature_models``, else ``default_model``);
+    short prompts of ``light_features`` go to ``light_model`` instead. The remaining
+    models follow as fallbacks. Models whose circuit is open or whose recent error
+    rate exceeds ``max_error_rate`` are moved to the end, and with ``slow_p95`` set a
+    preferred model whose p95 latency is above it yields to a faster healthy one.
+    A healthy ``prefer`` model, e.g. the one holding a cached context, goes first.
+    """
+
+    def __init__(
+        self,
+        default_model: str,
+        light_model: str = "",
+        fallback_models: Iterable[str] = (),
+        feature_models: Optional[Dict[str, str]] = None,
+        light_features: Iterable[str] = ("text",),
+        light_max_tokens: int = 0,
+        max_error_rate: float = 0.5,
+        slow_p95: float = 0.0,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+    ):
+        self.default_model = default_model
+        self.light_model = light_model
+        self.fallback_models = [model for model in fallback_models if model]
+        self.feature_models = feature_models or {}
+        self.light_features = set(light_features)
+        self.light_max_tokens = light_max_tokens
+        self.max_error_rate = max_error_rate
+        self.slow_p95 = slow_p95
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self._health: Dict[str, ModelHealth] = {}
+
+    def health(self, model: str) -> ModelHealth:
+        health = self._health.get(model)
+        if health is None:
+            health = self._health[model] = ModelHealth(self.breaker_failures, self.breaker_reset)
+        return health
+
+    def route(self, feature: str, prompt_tokens: int, prefer: Optional[str] = None) -> Route:
+        preferred = self.feature_models.get(feature, self.default_model)
+        reason = "feature" if feature in self.feature_models else "default"
+        if (self.light_model and feature in self.light_features
+                and prompt_tokens <= self.light_max_tokens and feature not in self.feature_models):
+            preferred = self.light_model
+            reason = "short_prompt"
+
+        if prefer and self.health(prefer).available(self.max_error_rate):
+            # A cached context only works with the model it was created for.
+            preferred = prefer
+            reason = "cached"
+
+        models = []
+        for model in [preferred, self.default_model, *self.fallback_models, self.light_model]:
+            if model and model not in models:
+                models.append(model)
+
+        healthy = [model for model in models if self.health(model).available(self.max_error_rate)]
+        if not healthy:
+            # Nothing looks healthy: keep the preferred order and let the breakers decide.
+            return Route(models, reason)
+        if healthy[0] != preferred:
+            reason = "degraded"
+        elif self.slow_p95 > 0 and len(healthy) > 1 and reason != "cached":
+            p95 = self.health(preferred).latency.p95
+            alternative = self.health(healthy[1]).latency.p95
+            if p95 is not None and p95 > self.slow_p95 and (alternative is None or alternative < p95):
+                healthy[0], healthy[1] = healthy[1], healthy[0]
+                reason = "slow"
+        return Route(healthy + [model for model in models if model not in healthy], reason)
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            model: {
+                "requests": health.requests,
+                "failures": health.failures,
+                "error_rate": round(health.error_rate, 4),
+                "available": int(health.available(self.max_error_rate)),
+                "p95_seconds": health.latency.p95,
+            }
+            for model, health in self._health.items()
+        }
+
+    def collect(self) -> dict:
+        """Metrics collector exporting the health of every model, labelled by model."""
+        metrics = {}
+        for model, stats in self.stats().items():
+            for key, value in stats.items():
+                if value is None:
+                    continue
+                _, samples = metrics.setdefault(f"gemini_model_{key}", (f"Routing health per model: {key}", {}))
+                samples[(("model", model),)] = value
+        return metrics
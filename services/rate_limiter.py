@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from services.resilience import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+JSONDict = Dict[str, Any]
+
+class FloodControlRateLimiter(BaseRateLimiter[None]):
+    """Keeps outgoing messages within Telegram's flood limits.
+
+    Every request aimed at a chat (sending, editing, ...) takes a token from that
+    chat's bucket and then from a global one, so the bot stays under the overall
+    messages-per-second limit and each chat under its own. A chat waits for its own
+    tokens before queueing for global ones, so a busy chat never holds up replies
+    to other chats, and the global bucket serves waiters in FIFO order. If Telegram
+    still answers with ``RetryAfter``, only the affected chat is paused for the
+    requested time and the request is sent again, up to ``max_retries`` times.
+    """
+
+    def __init__(self, overall_per_second: float, chat_per_second: float, chat_burst: float,
+                 group_per_minute: float, max_retries: int):
+        self._overall = TokenBucket(overall_per_second * 60, capacity=max(1.0, overall_per_second))
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._paused_until: Dict[Union[int, str], float] = {}
+        self.throttled_retries = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._prune()
+            # Group and channel ids are negative; they have a much lower per-minute limit.
+            if isinstance(chat_id, str) or chat_id < 0:
+                bucket = TokenBucket(self.group_per_minute, capacity=max(1.0, min(self.chat_burst, self.group_per_minute)))
+            else:
+                bucket = TokenBucket(self.chat_per_second * 60, capacity=max(1.0, self.chat_burst))
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _prune(self) -> None:
+        # Buckets that have refilled completely carry no state worth keeping.
+        for chat_id, bucket in list(self._chats.items()):
+            if bucket.idle:
+                del self._chats[chat_id]
+
+    async def _wait_pause(self, chat_id: Union[int, str]) -> None:
+        until = self._paused_until.get(chat_id)
+        while until is not None:
+            delay = until - time.monotonic()
+            if delay <= 0:
+                if self._paused_until.get(chat_id) == until:
+                    del self._paused_until[chat_id]
+                return
+            await asyncio.sleep(delay)
+            until = self._paused_until.get(chat_id)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, JSONDict, List[JSONDict]]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[None],
+    ) -> Union[bool, JSONDict, List[JSONDict]]:
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # getMe, getFile, answerCallbackQuery, ... aren't message flood limited.
+            return await callback(*args, **kwargs)
+
+        attempt = 0
+        while True:
+            await self._wait_pause(chat_id)
+            await self._chat_bucket(chat_id).acquire()
+            await self._overall.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.throttled_retries += 1
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                logger.warning("Telegram flood control for chat %s on %s, retrying in %.1fs", chat_id, endpoint, retry_after)
+                until = time.monotonic() + retry_after
+                self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0), until)
+
+    def stats(self) -> dict:
+        return {"chats_tracked": len(self._chats), "throttled_retries": self.throttled_retries}
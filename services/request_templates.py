@@ -0,0 +1,78 @@
+from typing import Any, Iterable, Optional
+from prompts.base_prompts import Prompts
+from services.media import dumps
+
+SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+class RequestTemplate:
+    """The parts of a generateContent request that are the same for every call of a mode.
+
+    The system prompt, safety settings, tools and generation config are serialized
+    once, here, and every request body only serializes its own contents around them.
+    ``feature`` names the mode for routing and metrics.
+    """
+
+    def __init__(self, feature: str, system_prompt: Optional[str] = None, tools: Iterable[dict] = (),
+                 generation_config: Optional[dict] = None):
+        self.feature = feature
+        self.system_prompt = system_prompt
+        static = {}
+        if system_prompt:
+            static["systemInstruction"] = {"parts": [{"text": system_prompt}]}
+        static["safetySettings"] = SAFETY_SETTINGS
+        tools = list(tools)
+        if tools:
+            static["tools"] = tools
+        if generation_config:
+            static["generationConfig"] = generation_config
+        # Members without the enclosing braces, ready to be spliced into a body.
+        self.static = dumps(static)[1:-1]
+        # A request that refers to a cached context gets the system instruction and
+        # tools from the cache and may not repeat them.
+        self.cached_members = {key: static[key] for key in ("systemInstruction", "tools") if key in static}
+        self.cached_static = dumps({key: value for key, value in static.items() if key not in self.cached_members})[1:-1]
+
+TEXT = RequestTemplate("text", Prompts.TEXT_GENERATION_PROMPT)
+IMAGE = RequestTemplate("image", Prompts.IMAGE_UNDERSTANDING_PROMPT)
+ALBUM = RequestTemplate("album", Prompts.ALBUM_UNDERSTANDING_PROMPT)
+VOICE = RequestTemplate("voice", Prompts.AUDIO_UNDERSTANDING_PROMPT)
+# The schema comes with each request, so it goes into the per-request generationConfig.
+STRUCTURED_OUTPUT = RequestTemplate("structured_output", Prompts.DEFAULT_PROMPT)
+CODE = RequestTemplate("code", Prompts.CODE_EXECUTION_PROMPT, tools=[{"code_execution": {}}])
+URL = RequestTemplate("url", Prompts.URL_CONTEXT_PROMPT, tools=[{"url_context": {}}])
+SEARCH = RequestTemplate("search", Prompts.GOOGLE_SEARCH_PROMPT, tools=[{"google_search": {}}])
+SUMMARY = RequestTemplate("summary")
+
+_SCHEMA_TYPES = {"STRING", "NUMBER", "INTEGER", "BOOLEAN", "ARRAY", "OBJECT"}
+
+def schema_from_example(value: Any) -> dict:
+    """Describe an example JSON value, e.g. ``{"name": "..."}``, as a Gemini response schema."""
+    if isinstance(value, dict):
+        return {
+            "type": "OBJECT",
+            "properties": {key: schema_from_example(item) for key, item in value.items()},
+            "required": list(value),
+            "propertyOrdering": list(value),
+        }
+    if isinstance(value, list):
+        return {"type": "ARRAY", "items": schema_from_example(value[0]) if value else {"type": "STRING"}}
+    if isinstance(value, bool):
+        return {"type": "BOOLEAN"}
+    if isinstance(value, int):
+        return {"type": "INTEGER"}
+    if isinstance(value, float):
+        return {"type": "NUMBER"}
+    if value is None:
+        return {"type": "STRING", "nullable": True}
+    return {"type": "STRING"}
+
+def response_schema(schema: Any) -> dict:
+    """Use ``schema`` as is if it already is a schema, otherwise treat it as an example."""
+    if isinstance(schema, dict) and isinstance(schema.get("type"), str) and schema["type"].upper() in _SCHEMA_TYPES:
+        return schema
+    return schema_from_example(schema)
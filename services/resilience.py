@@ -0,0 +1,183 @@
+import asyncio
+import email.utils
+import random
+import re
+import time
+from collections import deque
+from typing import Deque, Mapping, Optional
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling upstream while the circuit breaker is open."""
+
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate_per_minute``.
+
+    ``acquire`` waits until enough tokens are available. A rate of 0 disables the
+    limit. Requests larger than the capacity are let through once the bucket is
+    full, so an oversized prompt can't wait forever.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        if not self.enabled:
+            return
+        # The lock keeps waiters in FIFO order.
+        async with self._lock:
+            needed = min(amount, self.capacity)
+            while True:
+                self._refill()
+                if self._tokens >= needed:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((needed - self._tokens) / self.rate)
+
+    @property
+    def idle(self) -> bool:
+        """True when the bucket is full and nobody is waiting on it."""
+        self._refill()
+        return self._tokens >= self.capacity and not self._lock.locked()
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund, if negative) tokens after the real cost is known."""
+        if self.enabled:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+class RetryBudget:
+    """Allows retries only up to ``ratio`` of recent requests (plus a small floor),
+    so retries can't multiply load while upstream is struggling."""
+
+    def __init__(self, ratio: float, min_per_second: float = 1.0, window: float = 10.0):
+        self.ratio = ratio
+        self.min_retries = min_per_second * window
+        self.window = window
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+
+    def _expire(self, now: float) -> None:
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self) -> None:
+        self._requests.append(time.monotonic())
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+            return False
+        self._retries.append(now)
+        return True
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures and rejects calls for
+    ``reset_timeout`` seconds, then lets a single probe through (half-open)."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+
+    def allow(self) -> None:
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError("Gemini API circuit is open")
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN:
+            # A probe that never reported back (e.g. was cancelled) doesn't block forever.
+            if self._probe_in_flight and now - self._probe_started < self.reset_timeout:
+                raise CircuitOpenError("Gemini API circuit is half-open, probe in flight")
+            self._probe_in_flight = True
+            self._probe_started = now
+
+    @property
+    def rejecting(self) -> bool:
+        """Whether calls are currently turned away, without starting a probe."""
+        return self.state == self.OPEN and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._probe_in_flight = False
+        self.state = self.CLOSED
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+class LatencyTracker:
+    """Rolling window of latencies with a cached percentile."""
+
+    def __init__(self, size: int = 500, min_samples: int = 50, refresh_every: int = 20):
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._since_refresh = 0
+        self._p95: Optional[float] = None
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+        self._since_refresh += 1
+        if self._since_refresh >= self.refresh_every and len(self._samples) >= self.min_samples:
+            ordered = sorted(self._samples)
+            self._p95 = ordered[int(len(ordered) * 0.95) - 1]
+            self._since_refresh = 0
+
+    @property
+    def p95(self) -> Optional[float]:
+        return self._p95
+
+def backoff_delay(attempt: int, base: float, cap: float, retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with full jitter, never shorter than the server's ``Retry-After``."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+_RETRY_DELAY = re.compile(r'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+def parse_retry_after(headers: Mapping[str, str], body: str = "") -> Optional[float]:
+    value = headers.get("retry-after")
+    if value:
+        value = value.strip()
+        if value.replace(".", "", 1).isdigit():
+            return float(value)
+        try:
+            parsed = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            parsed = None
+        if parsed is not None:
+            return max(0.0, parsed.timestamp() - time.time())
+    # Gemini reports quota waits in the error body as google.rpc.RetryInfo.
+    match = _RETRY_DELAY.search(body)
+    if match:
+        return float(match.group(1))
+    return None
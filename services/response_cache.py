@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, ""))
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+def make_key(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+class Computed(NamedTuple):
+    """Result of a cache miss: the value, whether it may be cached, and how many
+    upstream bytes (downloads and request payload) a later hit avoids."""
+    value: str
+    cacheable: bool = True
+    upstream_bytes: int = 0
+
+class _Entry:
+    __slots__ = ("value", "size", "upstream_bytes", "expires_at")
+
+    def __init__(self, value: str, upstream_bytes: int, expires_at: float):
+        self.value = value
+        self.size = len(value.encode("utf-8"))
+        self.upstream_bytes = upstream_bytes
+        self.expires_at = expires_at
+
+class ResponseCache:
+    """Content-addressed cache of Gemini answers with single-flight coalescing.
+
+    Entries are evicted in LRU order once ``max_entries`` or ``max_bytes`` is
+    exceeded, and expire after ``ttl`` seconds. Concurrent lookups of a key that
+    is being computed wait for that computation instead of starting their own.
+    """
+
+    HIT = "hit"
+    COALESCED = "coalesced"
+    MISS = "miss"
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._inflight: dict = {}
+        self._bytes = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry.value
+
+    def put(self, key: str, value: str, upstream_bytes: int = 0) -> None:
+        if key in self._entries:
+            self._remove(key)
+        entry = _Entry(value, upstream_bytes, time.monotonic() + self.ttl)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    async def get_or_create(self, key: str, create: Callable[[], Awaitable[Computed]]) -> Tuple[str, str]:
+        """Return ``(value, status)`` where status is HIT, COALESCED or MISS.
+
+        On MISS the value was produced by ``create`` in this call, so the caller has
+        already done whatever side effects ``create`` performs (e.g. replying).
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            self.bytes_saved += self._entries[key].upstream_bytes
+            logger.debug("Response cache hit for %s", key[:12])
+            return value, self.HIT
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            computed = await asyncio.shield(inflight)
+            self.bytes_saved += computed.upstream_bytes
+            return computed.value, self.COALESCED
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            computed = await create()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting; don't let the loop report an unretrieved exception.
+            future.exception()
+            raise
+        else:
+            future.set_result(computed)
+            if computed.cacheable:
+                self.put(key, computed.value, computed.upstream_bytes)
+            return computed.value, self.MISS
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
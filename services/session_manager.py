@@ -0,0 +1,194 @@
+import time
+from collections import OrderedDict, deque
+from typing import Deque, List, Optional
+
+# Rough local token estimate: ~4 bytes of UTF-8 per token, fixed cost for media parts.
+BYTES_PER_TOKEN = 4
+MEDIA_PART_TOKENS = 258
+
+def estimate_tokens(message: dict) -> int:
+    tokens = 4  # role and framing overhead
+    for part in message.get("parts", []):
+        if "text" in part:
+            tokens += len(part["text"].encode("utf-8")) // BYTES_PER_TOKEN + 1
+        else:
+            tokens += MEDIA_PART_TOKENS
+    return tokens
+
+class ChatSession:
+    """History of one user's dialog with cached per-message token estimates."""
+
+    __slots__ = ("messages", "token_counts", "total_tokens", "summary", "summary_tokens", "last_access")
+
+    def __init__(self):
+        self.messages: Deque[dict] = deque()
+        self.token_counts: Deque[int] = deque()
+        self.total_tokens = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.last_access = time.monotonic()
+
+    def append(self, message: dict) -> None:
+        tokens = estimate_tokens(message)
+        self.messages.append(message)
+        self.token_counts.append(tokens)
+        self.total_tokens += tokens
+
+    def pop_oldest(self) -> dict:
+        self.total_tokens -= self.token_counts.popleft()
+        return self.messages.popleft()
+
+    def pop_latest(self) -> dict:
+        self.total_tokens -= self.token_counts.pop()
+        return self.messages.pop()
+
+    def set_summary(self, summary: str) -> None:
+        self.summary = summary
+        self.summary_tokens = estimate_tokens({"parts": [{"text": summary}]}) if summary else 0
+
+    @property
+    def size_tokens(self) -> int:
+        return self.total_tokens + self.summary_tokens
+
+    def contents(self, summary_template: str = "{summary}") -> List[dict]:
+        """Messages to send to Gemini, with the rolling summary in front when there is one."""
+        if not self.summary:
+            return list(self.messages)
+        return [
+            {"role": "user", "parts": [{"text": summary_template.format(summary=self.summary)}]},
+            {"role": "model", "parts": [{"text": "Понял, продолжаем."}]},
+            *self.messages,
+        ]
+
+class SessionManager:
+    """Bounded store of chat sessions.
+
+    Sessions are kept in LRU order and evicted when idle for longer than
+    ``idle_ttl`` seconds, when there are more than ``max_sessions`` of them, or when
+    their combined size exceeds ``memory_cap_tokens``. A session that grows past
+    ``token_budget`` is trimmed from the oldest turn down to ``trim_to`` tokens, so
+    with a lower ``trim_to`` the start of the history stays the same for several
+    turns at a time instead of moving on every message.
+    """
+
+    def __init__(self, max_sessions: int, idle_ttl: float, token_budget: int, memory_cap_tokens: int,
+                 trim_to: Optional[int] = None):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.token_budget = token_budget
+        self.trim_to = min(trim_to, token_budget) if trim_to is not None else token_budget
+        self.memory_cap_tokens = memory_cap_tokens
+        self._sessions: "OrderedDict[int, ChatSession]" = OrderedDict()
+        self._total_tokens = 0
+        self.evictions = 0
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._sessions
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def peek(self, user_id: int) -> Optional[ChatSession]:
+        return self._sessions.get(user_id)
+
+    def get(self, user_id: int) -> ChatSession:
+        now = time.monotonic()
+        self.evict_expired(now)
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = ChatSession()
+            self._sessions[user_id] = session
+        else:
+            self._sessions.move_to_end(user_id)
+        session.last_access = now
+        return session
+
+    def restore(self, user_id: int, snapshot: dict) -> ChatSession:
+        """Recreate a session from a persisted :meth:`snapshot`."""
+        self.reset(user_id)
+        session = self.get(user_id)
+        for message in snapshot.get("messages", []):
+            session.append(message)
+        session.set_summary(snapshot.get("summary", ""))
+        self._trim(session)
+        self._total_tokens += session.size_tokens
+        self._enforce_limits(keep=user_id)
+        return session
+
+    def snapshot(self, user_id: int) -> Optional[dict]:
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        return {"messages": list(session.messages), "summary": session.summary}
+
+    def reset(self, user_id: int) -> None:
+        session = self._sessions.pop(user_id, None)
+        if session is not None:
+            self._total_tokens -= session.size_tokens
+
+    def append(self, user_id: int, message: dict) -> List[dict]:
+        """Add a message to the session and trim it; returns the turns that were dropped."""
+        session = self.get(user_id)
+        before = session.size_tokens
+        session.append(message)
+        dropped = self._trim(session)
+        self._total_tokens += session.size_tokens - before
+        self._enforce_limits(keep=user_id)
+        return dropped
+
+    def discard_latest(self, user_id: int) -> None:
+        """Remove the newest message, e.g. a question that never got an answer."""
+        session = self._sessions.get(user_id)
+        if session is None or not session.messages:
+            return
+        before = session.size_tokens
+        session.pop_latest()
+        self._total_tokens += session.size_tokens - before
+
+    def set_summary(self, user_id: int, summary: str) -> None:
+        session = self._sessions.get(user_id)
+        if session is None:
+            return
+        before = session.size_tokens
+        session.set_summary(summary)
+        self._total_tokens += session.size_tokens - before
+
+    def _trim(self, session: ChatSession) -> List[dict]:
+        dropped = []
+        if session.size_tokens <= self.token_budget:
+            return dropped
+        # Always keep the latest message; drop whole user/model turns from the front.
+        while session.size_tokens > self.trim_to and len(session.messages) > 1:
+            dropped.append(session.pop_oldest())
+            while session.messages and session.messages[0].get("role") != "user" and len(session.messages) > 1:
+                dropped.append(session.pop_oldest())
+        return dropped
+
+    def evict_expired(self, now: Optional[float] = None) -> None:
+        now = time.monotonic() if now is None else now
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access < self.idle_ttl:
+                break
+            self._evict(user_id)
+
+    def _enforce_limits(self, keep: int) -> None:
+        while len(self._sessions) > self.max_sessions or self._total_tokens > self.memory_cap_tokens:
+            user_id = next(iter(self._sessions))
+            if user_id == keep:
+                break
+            self._evict(user_id)
+
+    def _evict(self, user_id: int) -> None:
+        self.reset(user_id)
+        self.evictions += 1
+
+    def stats(self) -> dict:
+        sessions = len(self._sessions)
+        return {
+            "sessions": sessions,
+            "total_tokens": self._total_tokens,
+            "approx_bytes": self._total_tokens * BYTES_PER_TOKEN,
+            "avg_tokens_per_session": self._total_tokens // sessions if sessions else 0,
+            "evictions": self.evictions,
+        }
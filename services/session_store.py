@@ -0,0 +1,299 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Record kinds kept in a store
+SESSION = "session"
+USER_DATA = "user_data"
+
+class SessionStore:
+    """Synchronous key/value storage for per-user records.
+
+    Methods are blocking and are only called from a worker thread by
+    :class:`WriteBehindWriter`, never from the event loop directly.
+    """
+
+    def load(self, kind: str, user_id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    def write_batch(self, records: Dict[Tuple[str, int], Optional[dict]]) -> None:
+        """Persist many records at once; a value of ``None`` deletes the record."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "kind TEXT NOT NULL, user_id INTEGER NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (kind, user_id)) WITHOUT ROWID"
+        )
+
+    def load(self, kind: str, user_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM records WHERE kind = ? AND user_id = ?", (kind, user_id)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_batch(self, records: Dict[Tuple[str, int], Optional[dict]]) -> None:
+        upserts = [(kind, user_id, json.dumps(data, ensure_ascii=False))
+                   for (kind, user_id), data in records.items() if data is not None]
+        deletes = [(kind, user_id) for (kind, user_id), data in records.items() if data is None]
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if upserts:
+                    self._conn.executemany(
+                        "INSERT INTO records (kind, user_id, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT (kind, user_id) DO UPDATE SET data = excluded.data",
+                        upserts,
+                    )
+                if deletes:
+                    self._conn.executemany("DELETE FROM records WHERE kind = ? AND user_id = ?", deletes)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+class AppendLogSessionStore(SessionStore):
+    """Append-only JSON-lines log.
+
+    The offset index is built on the first lookup rather than at startup, and the
+    log is rewritten once stale records outnumber live ones. The index is saved
+    next to the log on close and after compaction, so a restart only scans what
+    was appended after the snapshot. A restart after a crash still reads the log
+    from the last snapshot on; the SQLite store has no such scan.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[Tuple[str, int], int]] = None
+        self._stale = 0
+        self._file = open(path, "ab+")
+
+    def _load_snapshot(self) -> Tuple[Dict[Tuple[str, int], int], int, int]:
+        """The saved index, stale count and log size it covers, if it matches the log."""
+        try:
+            with open(self.index_path, "rb") as f:
+                snapshot = json.load(f)
+            stat = os.fstat(self._file.fileno())
+            if snapshot["inode"] != stat.st_ino or snapshot["size"] > stat.st_size:
+                # the log was replaced or truncated after the snapshot was taken
+                return {}, 0, 0
+            index = {(kind, user_id): offset for kind, user_id, offset in snapshot["index"]}
+            return index, snapshot["stale"], snapshot["size"]
+        except FileNotFoundError:
+            return {}, 0, 0
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unreadable index snapshot %s: %s", self.index_path, e)
+            return {}, 0, 0
+
+    def _save_snapshot(self) -> None:
+        self._file.seek(0, os.SEEK_END)
+        stat = os.fstat(self._file.fileno())
+        snapshot = {
+            "inode": stat.st_ino,
+            "size": self._file.tell(),
+            "stale": self._stale,
+            "index": [[kind, user_id, offset] for (kind, user_id), offset in self._index.items()],
+        }
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            json.dump(snapshot, tmp, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def _ensure_index(self) -> Dict[Tuple[str, int], int]:
+        if self._index is None:
+            index, stale, offset = self._load_snapshot()
+            self._file.seek(offset)
+            for line in self._file:
+                try:
+                    record = json.loads(line)
+                    key = (record["kind"], record["user_id"])
+                except (ValueError, KeyError):
+                    # a torn final write after a crash
+                    offset += len(line)
+                    continue
+                if key in index:
+                    stale += 1
+                if record.get("data") is None:
+                    index.pop(key, None)
+                    stale += 1
+                else:
+                    index[key] = offset
+                offset += len(line)
+            self._index = index
+            self._stale = stale
+        return self._index
+
+    def load(self, kind: str, user_id: int) -> Optional[dict]:
+        with self._lock:
+            offset = self._ensure_index().get((kind, user_id))
+            if offset is None:
+                return None
+            self._file.seek(offset)
+            return json.loads(self._file.readline())["data"]
+
+    def write_batch(self, records: Dict[Tuple[str, int], Optional[dict]]) -> None:
+        with self._lock:
+            index = self._ensure_index()
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            lines = []
+            for (kind, user_id), data in records.items():
+                line = (json.dumps({"kind": kind, "user_id": user_id, "data": data}, ensure_ascii=False) + "\n").encode("utf-8")
+                if (kind, user_id) in index:
+                    self._stale += 1
+                if data is None:
+                    index.pop((kind, user_id), None)
+                else:
+                    index[(kind, user_id)] = offset
+                offset += len(line)
+                lines.append(line)
+            self._file.write(b"".join(lines))
+            self._file.flush()
+            if self._stale > max(len(index), 1000):
+                self._compact()
+
+    def _compact(self) -> None:
+        tmp_path = self.path + ".tmp"
+        index = {}
+        with open(tmp_path, "wb") as tmp:
+            for key, offset in self._index.items():
+                self._file.seek(offset)
+                line = self._file.readline()
+                index[key] = tmp.tell()
+                tmp.write(line)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "ab+")
+        self._index = index
+        self._stale = 0
+        self._save_snapshot()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._index is not None:
+                try:
+                    self._save_snapshot()
+                except OSError as e:
+                    logger.warning("Could not save index snapshot %s: %s", self.index_path, e)
+            self._file.close()
+
+def create_session_store(backend: str, path: str) -> Optional[SessionStore]:
+    if not backend or backend == "none":
+        return None
+    if backend == "sqlite":
+        return SQLiteSessionStore(path)
+    if backend == "log":
+        return AppendLogSessionStore(path)
+    raise ValueError(f"Unknown persistence backend: {backend}")
+
+class WriteBehindWriter:
+    """Collects record updates in memory and writes them to a store in batches.
+
+    ``put`` only touches a dict, so the event loop never waits for disk. A
+    background task flushes every ``flush_interval`` seconds, or sooner once
+    ``batch_size`` records are pending. Only the latest version of each record is
+    written.
+    """
+
+    def __init__(self, store: SessionStore, flush_interval: float, batch_size: int):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending: Dict[Tuple[str, int], Optional[dict]] = {}
+        self._writing: Dict[Tuple[str, int], Optional[dict]] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.records_written = 0
+        self.flush_errors = 0
+
+    def put(self, kind: str, user_id: int, data: Optional[dict]) -> None:
+        self._pending[(kind, user_id)] = data
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def load(self, kind: str, user_id: int) -> Optional[dict]:
+        key = (kind, user_id)
+        for batch in (self._pending, self._writing):
+            if key in batch:
+                return batch[key]
+        return await asyncio.to_thread(self.store.load, kind, user_id)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to persist %d pending records", len(self._pending))
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            self._writing = batch
+            try:
+                await asyncio.to_thread(self.store.write_batch, batch)
+            except Exception:
+                # Keep newer updates that arrived meanwhile, retry the rest next time.
+                for key, value in batch.items():
+                    self._pending.setdefault(key, value)
+                self.flush_errors += 1
+                raise
+            finally:
+                self._writing = {}
+            self.flushes += 1
+            self.records_written += len(batch)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "records_written": self.records_written,
+            "flush_errors": self.flush_errors,
+        }
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await asyncio.to_thread(self.store.close)
@@ -0,0 +1,224 @@
+import json
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+# Events emitted while decoding a streamGenerateContent response.
+
+@dataclass
+class TextDelta:
+    text: str
+
+@dataclass
+class FinishReason:
+    reason: str
+
+@dataclass
+class UsageMetadata:
+    prompt_tokens: int = 0
+    candidates_tokens: int = 0
+    total_tokens: int = 0
+    cached_tokens: int = 0
+
+@dataclass
+class SafetyBlock:
+    reason: str
+    ratings: list = field(default_factory=list)
+
+# Inside a JSON string only quotes and backslashes matter; outside of one only
+# braces and quotes do. Jumping between these with a regex keeps the scan in C.
+_STRUCTURAL = re.compile(rb'[{}"]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+
+class StreamDecoder:
+    """Incremental decoder for Gemini streaming responses.
+
+    Accepts raw body chunks cut at arbitrary byte boundaries and understands both
+    SSE framing (``alt=sse``) and the default JSON-array framing. Every byte is
+    scanned once, so decoding is linear in the size of the stream.
+    """
+
+    SSE = "sse"
+    JSON = "json"
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._mode: Optional[str] = None
+        # SSE state
+        self._data_lines: List[bytes] = []
+        self._line_scan = 0
+        # JSON scanner state
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._start = -1
+
+    def feed(self, chunk: bytes) -> list:
+        if not chunk:
+            return []
+        self._buffer += chunk
+        if self._mode is None:
+            self._mode = self._detect_mode()
+            if self._mode is None:
+                return []
+        if self._mode == self.SSE:
+            return self._feed_sse()
+        return self._feed_json()
+
+    def close(self) -> list:
+        """Flush anything left in the buffer at the end of the stream."""
+        events = []
+        if self._mode == self.SSE:
+            if self._buffer:
+                self._buffer += b"\n"
+                events.extend(self._feed_sse())
+            events.extend(self._dispatch_sse())
+        self._buffer.clear()
+        return events
+
+    def _detect_mode(self) -> Optional[str]:
+        stripped = self._buffer.lstrip()
+        if not stripped:
+            return None
+        if stripped[:1] in (b"[", b"{", b","):
+            return self.JSON
+        return self.SSE
+
+    # SSE framing
+
+    def _feed_sse(self) -> list:
+        events = []
+        buffer = self._buffer
+        start = 0
+        while True:
+            end = buffer.find(b"\n", max(start, self._line_scan))
+            if end == -1:
+                self._line_scan = len(buffer) - start
+                break
+            line = bytes(buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            self._line_scan = 0
+            if not line:
+                events.extend(self._dispatch_sse())
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                if value.startswith(b" "):
+                    value = value[1:]
+                self._data_lines.append(value)
+            # comments (":") and other fields (event:, id:, retry:) carry nothing we need
+        del buffer[:start]
+        return events
+
+    def _dispatch_sse(self) -> list:
+        if not self._data_lines:
+            return []
+        payload = b"\n".join(self._data_lines)
+        self._data_lines = []
+        return self._parse(payload)
+
+    # JSON-array framing
+
+    def _feed_json(self) -> list:
+        events = []
+        buffer = self._buffer
+        pos = self._pos
+        size = len(buffer)
+
+        while pos < size:
+            if self._in_string:
+                match = _STRING_SPECIAL.search(buffer, pos)
+                if match is None:
+                    pos = size
+                    break
+                if match.group() == b"\\":
+                    if match.end() >= size:
+                        # the escaped byte hasn't arrived yet
+                        pos = match.start()
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                continue
+
+            match = _STRUCTURAL.search(buffer, pos)
+            if match is None:
+                pos = size
+                break
+            char = match.group()
+            pos = match.end()
+            if char == b'"':
+                self._in_string = True
+            elif char == b"{":
+                if self._depth == 0:
+                    self._start = match.start()
+                self._depth += 1
+            elif self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    events.extend(self._parse(bytes(buffer[self._start:pos])))
+                    self._start = -1
+
+        # Drop everything that can't be part of an unfinished object.
+        keep_from = self._start if self._depth > 0 else pos
+        if keep_from > 0:
+            del buffer[:keep_from]
+            pos -= keep_from
+            if self._start >= 0:
+                self._start -= keep_from
+        self._pos = pos
+        return events
+
+    # Payload interpretation
+
+    def _parse(self, payload: bytes) -> list:
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            return []
+        if isinstance(data, list):
+            events = []
+            for item in data:
+                if isinstance(item, dict):
+                    events.extend(self._interpret(item))
+            return events
+        if isinstance(data, dict):
+            return self._interpret(data)
+        return []
+
+    @staticmethod
+    def _interpret(data: dict) -> list:
+        events = []
+        prompt_feedback = data.get("promptFeedback") or {}
+        if prompt_feedback.get("blockReason"):
+            events.append(SafetyBlock(prompt_feedback["blockReason"], prompt_feedback.get("safetyRatings", [])))
+
+        candidates = data.get("candidates") or []
+        if candidates:
+            candidate = candidates[0]
+            for part in (candidate.get("content") or {}).get("parts", []):
+                if "text" in part and not part.get("thought"):
+                    events.append(TextDelta(part["text"]))
+                elif "executableCode" in part:
+                    code = part["executableCode"]
+                    language = code.get("language", "").lower().replace("language_unspecified", "")
+                    events.append(TextDelta(f"\n```{language}\n{code.get('code', '').rstrip()}\n```\n"))
+                elif "codeExecutionResult" in part:
+                    output = part["codeExecutionResult"].get("output", "").rstrip()
+                    if output:
+                        events.append(TextDelta(f"\n```\n{output}\n```\n"))
+            finish_reason = candidate.get("finishReason")
+            if finish_reason:
+                if finish_reason in ("SAFETY", "PROHIBITED_CONTENT", "BLOCKLIST", "SPII"):
+                    events.append(SafetyBlock(finish_reason, candidate.get("safetyRatings", [])))
+                events.append(FinishReason(finish_reason))
+
+        usage = data.get("usageMetadata")
+        if usage:
+            events.append(UsageMetadata(
+                prompt_tokens=usage.get("promptTokenCount", 0),
+                candidates_tokens=usage.get("candidatesTokenCount", 0),
+                total_tokens=usage.get("totalTokenCount", 0),
+                cached_tokens=usage.get("cachedContentTokenCount", 0),
+            ))
+        return events
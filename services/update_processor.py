@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, Hashable, Set, Tuple
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+OVERLOADED_TEXT = "Бот сейчас перегружен запросами. Пожалуйста, повторите сообщение через минуту."
+
+class FairUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates of different users concurrently, each user's strictly in order.
+
+    At most ``max_concurrent`` updates run at once, and each user has at most one
+    running update, so chat history and ``user_data['state']`` are never modified
+    concurrently. Users with pending updates take turns in round-robin order, so a
+    user sending many messages can't starve the others. Once ``max_queued`` updates
+    are waiting overall, or ``max_queued_per_user`` for a single user, new updates
+    are answered with a short "overloaded" reply instead of being queued.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int, max_queued_per_user: int):
+        # The base class semaphore is sized so it never becomes the bottleneck;
+        # concurrency is limited by the scheduler below instead.
+        super().__init__(max_concurrent + max_queued)
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self._queues: Dict[Hashable, Deque[Tuple[Awaitable[Any], asyncio.Future]]] = {}
+        self._ready: Deque[Hashable] = deque()
+        self._running: Set[Hashable] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._queued = 0
+        self.shed = 0
+
+    @staticmethod
+    def _key(update: object) -> Hashable:
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return ("chat", update.effective_chat.id)
+        # Updates without a user or chat don't need ordering.
+        return ("update", id(update))
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self._key(update)
+        queue = self._queues.get(key)
+        if self._queued >= self.max_queued or (queue is not None and len(queue) >= self.max_queued_per_user):
+            coroutine.close()
+            await self._shed(update)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[key] = deque()
+            if key not in self._running:
+                self._ready.append(key)
+        queue.append((coroutine, future))
+        self._queued += 1
+        self._dispatch()
+        await future
+
+    def _dispatch(self) -> None:
+        while self._ready and len(self._running) < self.max_concurrent:
+            key = self._ready.popleft()
+            coroutine, future = self._queues[key].popleft()
+            self._queued -= 1
+            self._running.add(key)
+            task = asyncio.create_task(self._run(key, coroutine, future))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: Hashable, coroutine: Awaitable[Any], future: asyncio.Future) -> None:
+        try:
+            await coroutine
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            if not future.done():
+                future.set_result(None)
+            self._running.discard(key)
+            if self._queues[key]:
+                # Back of the line, behind every other user who is waiting.
+                self._ready.append(key)
+            else:
+                del self._queues[key]
+            self._dispatch()
+
+    async def _shed(self, update: object) -> None:
+        self.shed += 1
+        logger.warning("Update queue is full (%d waiting), dropping update", self._queued)
+        if isinstance(update, Update) and update.effective_message is not None:
+            try:
+                await update.effective_message.reply_text(OVERLOADED_TEXT)
+            except TelegramError as e:
+                logger.debug("Could not send overload notice: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "queued": self._queued,
+            "users_waiting": len(self._ready),
+            "shed": self.shed,
+        }
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
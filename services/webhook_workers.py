@@ -0,0 +1,412 @@
+"""Webhook mode: one receiver process in front of several bot worker processes.
+
+The receiver accepts Telegram's webhook requests, answers them right away and
+forwards each update to the worker that owns its user (``user id % workers``).
+Every worker runs its own Application and GeminiService, so a user's history and
+state live in exactly one process and need no locking.
+
+Flow control is credit based: each worker has at most ``max_pending`` forwarded
+updates that it hasn't finished yet. Updates beyond that wait in the receiver, and
+once a shard's backlog is full the webhook request is answered with 503 so that
+Telegram delivers the update again later. Crashed workers are restarted; on
+shutdown the receiver stops accepting updates, hands the backlog over and lets
+the workers finish every reply before they exit.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import struct
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Connection
+from typing import Deque, List, Optional
+
+from config.settings import (
+    TELEGRAM_BOT_TOKEN,
+    TELEGRAM_API_URL,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_WORKERS,
+    WEBHOOK_WORKER_MAX_PENDING,
+    WEBHOOK_DRAIN_TIMEOUT,
+    METRICS_PORT,
+    METRICS_HOST,
+)
+from services.metrics import REGISTRY, MetricsServer, stats_collector
+
+logger = logging.getLogger(__name__)
+
+_LENGTH = struct.Struct("!I")
+RESTART_DELAY = 1.0  # seconds between restarts of a crashing worker
+MAX_BATCH = 256  # updates sent to a worker in one pipe message
+
+def shard_key(update: dict) -> int:
+    """The user an update belongs to, falling back to its chat, then to its id."""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if user and "id" in user:
+                return user["id"]
+            chat = value.get("chat") or value.get("message", {}).get("chat")
+            if chat and "id" in chat:
+                return chat["id"]
+    return update.get("update_id", 0)
+
+def _pack(items: List[bytes]) -> bytes:
+    return b"".join(_LENGTH.pack(len(item)) + item for item in items)
+
+def _unpack(data: bytes) -> List[bytes]:
+    items = []
+    offset = 0
+    while offset < len(data):
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        items.append(data[offset:offset + length])
+        offset += length
+    return items
+
+# ---------------------------------------------------------------------------
+# Worker process
+# ---------------------------------------------------------------------------
+
+def worker_main(index: int, workers: int, updates: Connection, acks: Connection, metrics_port: int) -> None:
+    # Ctrl+C reaches the whole process group; the receiver decides when workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format=f"%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    asyncio.run(_run_worker(index, workers, updates, acks, metrics_port))
+
+async def _run_worker(index: int, workers: int, updates: Connection, acks: Connection, metrics_port: int) -> None:
+    from telegram import Update
+    import main
+
+    # Updates come from the receiver, so the worker doesn't need an Updater.
+    application = main.build_application(
+        main.default_builder().updater(None), metrics_port=metrics_port, worker=index, workers=workers,
+    )
+    await application.initialize()
+    await main.post_init(application)
+    await application.start()
+
+    loop = asyncio.get_running_loop()
+    closed = asyncio.Event()
+    finished = 0
+    ack_ready = asyncio.Event()
+
+    def on_done(_task: asyncio.Task) -> None:
+        nonlocal finished
+        finished += 1
+        ack_ready.set()
+
+    def deliver(raw: bytes) -> None:
+        update = Update.de_json(json.loads(raw), application.bot)
+        # Same path as updates from the Application's own queue: the update processor
+        # keeps each user's updates in order.
+        task = application.create_task(
+            application.update_processor.process_update(update, application.process_update(update)),
+            update=update,
+        )
+        task.add_done_callback(on_done)
+
+    def receive() -> None:
+        try:
+            while True:
+                batch = updates.recv_bytes()
+                if not batch:
+                    break  # the receiver asks us to drain and stop
+                for raw in _unpack(batch):
+                    loop.call_soon_threadsafe(deliver, raw)
+        except (EOFError, OSError):
+            logger.warning("Lost connection to the webhook receiver")
+        finally:
+            loop.call_soon_threadsafe(closed.set)
+
+    async def send_acks() -> None:
+        nonlocal finished
+        while True:
+            await ack_ready.wait()
+            ack_ready.clear()
+            await asyncio.sleep(0.01)  # let acks of concurrently finishing updates batch up
+            count, finished = finished, 0
+            try:
+                acks.send_bytes(_LENGTH.pack(count))
+            except (BrokenPipeError, OSError):
+                return
+
+    threading.Thread(target=receive, name="webhook-updates", daemon=True).start()
+    ack_task = asyncio.create_task(send_acks())
+    logger.info("Worker %d ready", index)
+    await closed.wait()
+
+    # Application.stop() waits for every task started with create_task, i.e. all
+    # updates this worker has accepted, so no reply is cut off.
+    await application.stop()
+    # Same order as run_polling: shutdown() flushes the persistence, and only then
+    # does post_shutdown close the store.
+    await application.shutdown()
+    await main.post_shutdown(application)
+    ack_task.cancel()
+    logger.info("Worker %d stopped", index)
+
+# ---------------------------------------------------------------------------
+# Receiver process
+# ---------------------------------------------------------------------------
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.updates: Optional[Connection] = None
+        self.acks: Optional[Connection] = None
+        self.backlog: Deque[bytes] = deque()
+        self.in_flight = 0
+        self.wakeup = asyncio.Event()
+        self.restarts = 0
+        self.started_at = 0.0
+        self.sender: Optional[asyncio.Task] = None
+        self.sending: Optional[asyncio.Future] = None  # the batch being written to the pipe
+
+class ShardedWebhookServer:
+    def __init__(self, workers: int = WEBHOOK_WORKERS, max_pending: int = WEBHOOK_WORKER_MAX_PENDING,
+                 host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN):
+        self.max_pending = max_pending
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(index) for index in range(max(1, workers))]
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._monitor: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.accepted = 0
+        self.rejected = 0
+
+    # Workers ---------------------------------------------------------------
+
+    def _spawn(self, worker: _Worker) -> None:
+        updates_reader, updates_writer = self._context.Pipe(duplex=False)
+        acks_reader, acks_writer = self._context.Pipe(duplex=False)
+        metrics_port = METRICS_PORT + 1 + worker.index if METRICS_PORT else 0
+        worker.process = self._context.Process(
+            target=worker_main,
+            args=(worker.index, len(self._workers), updates_reader, acks_writer, metrics_port),
+            name=f"bot-worker-{worker.index}",
+            daemon=False,
+        )
+        worker.process.start()
+        # The child has its own copies of these ends.
+        updates_reader.close()
+        acks_writer.close()
+        worker.updates = updates_writer
+        worker.acks = acks_reader
+        worker.in_flight = 0
+        worker.started_at = time.monotonic()
+        loop = asyncio.get_running_loop()
+        threading.Thread(target=self._read_acks, args=(worker, acks_reader, loop),
+                         name=f"webhook-acks-{worker.index}", daemon=True).start()
+        worker.sender = asyncio.create_task(self._send(worker, updates_writer))
+        logger.info("Started worker %d (pid %d)", worker.index, worker.process.pid)
+
+    def _read_acks(self, worker: _Worker, acks: Connection, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            while True:
+                (count,) = _LENGTH.unpack(acks.recv_bytes())
+                loop.call_soon_threadsafe(self._on_ack, worker, acks, count)
+        except (EOFError, OSError):
+            pass
+
+    def _on_ack(self, worker: _Worker, acks: Connection, count: int) -> None:
+        if acks is not worker.acks:
+            return  # late ack from a worker that has since been replaced
+        worker.in_flight = max(0, worker.in_flight - count)
+        worker.wakeup.set()
+
+    async def _send(self, worker: _Worker, updates: Connection) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await worker.wakeup.wait()
+            worker.wakeup.clear()
+            while worker.backlog and worker.in_flight < self.max_pending and updates is worker.updates:
+                count = min(len(worker.backlog), self.max_pending - worker.in_flight, MAX_BATCH)
+                batch = [worker.backlog.popleft() for _ in range(count)]
+                worker.in_flight += count
+                try:
+                    # A large batch can fill the pipe buffer; don't block the receiver on it.
+                    # Cancelling the sender can't stop the write, so it is shielded and
+                    # kept for stop() to wait on.
+                    worker.sending = loop.run_in_executor(None, updates.send_bytes, _pack(batch))
+                    await asyncio.shield(worker.sending)
+                except (BrokenPipeError, OSError):
+                    logger.warning("Worker %d is gone, %d updates were not delivered", worker.index, count)
+                    return
+
+    async def _watch_workers(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(0.5)
+            for worker in self._workers:
+                if self._stopping or worker.process.is_alive():
+                    continue
+                lost = worker.in_flight
+                logger.error("Worker %d exited with code %s, losing %d unfinished updates; restarting",
+                             worker.index, worker.process.exitcode, lost)
+                worker.sender.cancel()
+                if worker.sending is not None:
+                    await asyncio.wait([worker.sending])
+                worker.updates.close()
+                worker.acks.close()
+                # Don't spin if the worker dies right after starting.
+                await asyncio.sleep(max(0.0, worker.started_at + RESTART_DELAY - time.monotonic()))
+                worker.restarts += 1
+                self._spawn(worker)
+                worker.wakeup.set()
+
+    # HTTP ------------------------------------------------------------------
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                status = self._accept(request_line.decode("latin-1").split(), headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1"))
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _accept(self, request_line: List[str], headers: dict, body: bytes) -> str:
+        if len(request_line) < 2 or request_line[0] != "POST" or request_line[1].split("?")[0] != self.path:
+            return "404 Not Found"
+        if self.secret_token and headers.get("x-telegram-bot-api-secret-token") != self.secret_token:
+            return "403 Forbidden"
+        if self._stopping:
+            return "503 Service Unavailable"
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return "400 Bad Request"
+        worker = self._workers[shard_key(update) % len(self._workers)]
+        if len(worker.backlog) + worker.in_flight >= 2 * self.max_pending:
+            # Telegram redelivers updates that weren't answered with 2xx.
+            self.rejected += 1
+            return "503 Service Unavailable"
+        worker.backlog.append(body)
+        worker.wakeup.set()
+        self.accepted += 1
+        return "200 OK"
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "backlog": sum(len(worker.backlog) for worker in self._workers),
+            "in_flight": sum(worker.in_flight for worker in self._workers),
+            "worker_restarts": sum(worker.restarts for worker in self._workers),
+        }
+
+    # Lifecycle -------------------------------------------------------------
+
+    async def start(self) -> None:
+        for worker in self._workers:
+            self._spawn(worker)
+        self._monitor = asyncio.create_task(self._watch_workers())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Webhook receiver listening on %s:%d%s with %d workers",
+                    self.host, self.port, self.path, len(self._workers))
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT) -> None:
+        """Stop accepting updates, hand the backlog to the workers and let them finish."""
+        self._stopping = True
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._monitor is not None:
+            self._monitor.cancel()
+
+        deadline = time.monotonic() + timeout
+        while any(worker.backlog for worker in self._workers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        loop = asyncio.get_running_loop()
+        for worker in self._workers:
+            if worker.backlog:
+                logger.warning("Worker %d: dropping %d updates that could not be delivered in time",
+                               worker.index, len(worker.backlog))
+            worker.sender.cancel()
+            # A Connection is not thread-safe: the stop frame may only go out once the
+            # batch still being written by the executor is complete.
+            if worker.sending is not None:
+                await asyncio.wait([worker.sending])
+            try:
+                await loop.run_in_executor(None, worker.updates.send_bytes, b"")
+            except (BrokenPipeError, OSError):
+                pass
+
+        for worker in self._workers:
+            await loop.run_in_executor(None, worker.process.join, max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                logger.warning("Worker %d did not finish in time, terminating it", worker.index)
+                worker.process.terminate()
+                await loop.run_in_executor(None, worker.process.join, 5)
+            worker.updates.close()
+            worker.acks.close()
+
+async def _serve() -> None:
+    from telegram import Bot, Update
+
+    server = ShardedWebhookServer()
+    metrics_server = None
+    if METRICS_PORT:
+        REGISTRY.register_collector(stats_collector("bot_webhook", "Webhook receiver", server.stats))
+        metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+        await metrics_server.start()
+    await server.start()
+
+    async with Bot(TELEGRAM_BOT_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot") as bot:
+        await bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+    await stop.wait()
+
+    logger.info("Shutting down, waiting for workers to finish their replies")
+    # The webhook stays registered: Telegram keeps updates until we are back.
+    await server.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+def run_webhook() -> None:
+    asyncio.run(_serve())
@@ -0,0 +1,39 @@
+import pytest
+
+from utils.text_utils import FENCE, MAX_MESSAGE_LENGTH, split_message, utf16_len
+
+def _visible(text: str) -> str:
+    return "".join(text.split())
+
+@pytest.mark.parametrize("text", [
+    "intro\n```" + "x" * 4100,
+    "intro\n```python" + "x" * 9000 + "\nprint(1)\n```\noutro",
+    "```" + "😀" * 3000,
+    "`" * 5000,
+    "```python\n" + "x = '😀😀'\n" * 2000 + "```\n",
+], ids=["fence-over-limit", "fence-tag-over-limit", "fence-astral", "backticks", "code-astral"])
+def test_fence_lines_of_any_length_fit(text):
+    chunks = split_message(text)
+    assert chunks
+    assert all(utf16_len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+
+@pytest.mark.parametrize("text", [
+    "😀" * 5000,
+    ("😀 слово " * 900 + "\n\n") * 3,
+    "a" * 10000,
+], ids=["astral", "astral-words", "ascii"])
+def test_chunks_fit_and_keep_the_text(text):
+    chunks = split_message(text)
+    assert all(utf16_len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
+    assert _visible("".join(chunks)) == _visible(text)
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 8, 20])
+def test_tiny_limits_terminate(limit):
+    assert split_message("```" + "😀" * 50 + "\n" + "x" * 50, limit)
+
+def test_code_block_is_reopened_with_its_language():
+    text = "```python\n" + "print(1)\n" * 1000 + "```"
+    chunks = split_message(text)
+    assert len(chunks) > 1
+    assert all(chunk.startswith("```python\n") and chunk.endswith(FENCE) for chunk in chunks)
+    assert all(utf16_len(chunk) <= MAX_MESSAGE_LENGTH for chunk in chunks)
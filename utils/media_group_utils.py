@@ -0,0 +1,48 @@
+import asyncio
+import time
+from typing import Dict, Hashable, List
+from telegram import Message
+
+class _PendingGroup:
+    __slots__ = ("messages", "last_added")
+
+    def __init__(self, message: Message):
+        self.messages: List[Message] = [message]
+        self.last_added = time.monotonic()
+
+class MediaGroupCollector:
+    """Collects the messages of a Telegram album (same ``media_group_id``).
+
+    Telegram delivers one update per album item. The first item starts a group;
+    items arriving within ``window`` seconds of the previous one are added to it,
+    and :meth:`wait` returns all of them once the album has been quiet for
+    ``window`` seconds.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._groups: Dict[Hashable, _PendingGroup] = {}
+
+    def add(self, key: Hashable, message: Message) -> bool:
+        """Add a message to a pending group; returns False if no such group exists yet."""
+        group = self._groups.get(key)
+        if group is None:
+            return False
+        group.messages.append(message)
+        group.last_added = time.monotonic()
+        return True
+
+    def start(self, key: Hashable, message: Message) -> None:
+        self._groups[key] = _PendingGroup(message)
+
+    async def wait(self, key: Hashable) -> List[Message]:
+        """Wait until the group has been quiet for ``window`` seconds and return its messages."""
+        group = self._groups[key]
+        try:
+            while True:
+                remaining = group.last_added + self.window - time.monotonic()
+                if remaining <= 0:
+                    return group.messages
+                await asyncio.sleep(remaining)
+        finally:
+            del self._groups[key]
@@ -0,0 +1,65 @@
+import asyncio
+import io
+import logging
+import os
+import tempfile
+from typing import Optional
+from telegram import Bot
+from config.settings import GEMINI_INLINE_MAX_BYTES, MEDIA_TMP_DIR, PHOTO_MAX_SIDE, PHOTO_JPEG_QUALITY
+from services.media import MediaPayload
+from services.metrics import PAYLOAD_BYTES, span
+
+logger = logging.getLogger(__name__)
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, only needed for PHOTO_MAX_SIDE
+    Image = None
+
+async def download_media(bot: Bot, file_id: str, mime_type: str, file_size: Optional[int] = None) -> MediaPayload:
+    """Download a Telegram file without keeping extra copies of it.
+
+    Small files are read into a single buffer that is used as-is; files that will
+    go through the Files API are spooled to a temporary file instead.
+    """
+    with span("telegram_download"):
+        telegram_file = await bot.get_file(file_id)
+        size = file_size or telegram_file.file_size or 0
+        if size > GEMINI_INLINE_MAX_BYTES:
+            fd, path = tempfile.mkstemp(prefix="tg-media-", dir=MEDIA_TMP_DIR)
+            os.close(fd)
+            try:
+                await telegram_file.download_to_drive(path)
+            except BaseException:
+                os.unlink(path)
+                raise
+            media = MediaPayload(mime_type, path=path, delete_file=True)
+        else:
+            buffer = await telegram_file.download_as_bytearray()
+            media = MediaPayload(mime_type, buffer)
+    PAYLOAD_BYTES.observe(media.size, kind="media_download")
+    return media
+
+def _downscale(data: memoryview) -> Optional[bytes]:
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= PHOTO_MAX_SIDE:
+            return None
+        image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+        out = io.BytesIO()
+        image.convert("RGB").save(out, format="JPEG", quality=PHOTO_JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+
+async def prepare_photo(media: MediaPayload) -> MediaPayload:
+    """Optionally downscale and re-encode a photo before it is sent to Gemini."""
+    if not PHOTO_MAX_SIDE or Image is None or media.data is None:
+        return media
+    try:
+        with span("media_prepare"):
+            resized = await asyncio.to_thread(_downscale, media.data)
+    except Exception as e:
+        logger.warning("Could not downscale photo, sending original: %s", e)
+        return media
+    if resized is None:
+        return media
+    media.cleanup()
+    return MediaPayload("image/jpeg", resized)
@@ -0,0 +1,124 @@
+import logging
+import time
+from typing import AsyncIterator, List, Optional, Union
+from telegram import Message, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from config.settings import STREAM_EDIT_INTERVAL, STREAM_EDIT_MIN_CHARS
+from services.gemini_service import StreamRestarted
+from services.metrics import PAYLOAD_BYTES, record_span, span
+from utils.text_utils import split_message
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_TEXT = "…"
+
+async def _edit(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+    try:
+        with span("telegram_edit"):
+            await message.edit_text(text, reply_markup=reply_markup)
+    except BadRequest as e:
+        # Telegram rejects edits that don't change anything; that is harmless here.
+        if "not modified" not in str(e).lower():
+            raise
+
+async def reply_long_text(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> Message:
+    """Reply with ``text`` split into as many messages as needed.
+
+    The keyboard is attached to the last message. Returns the last message sent.
+    """
+    chunks = split_message(text)
+    for index, chunk in enumerate(chunks):
+        last = index == len(chunks) - 1
+        with span("telegram_send"):
+            sent = await message.reply_text(chunk, reply_markup=reply_markup if last else None)
+    PAYLOAD_BYTES.observe(len(text.encode("utf-8")), kind="reply_text")
+    return sent
+
+class _StreamedReply:
+    """The Telegram messages showing one streamed answer, one per chunk of text."""
+
+    def __init__(self, message: Message, placeholder: Message):
+        self.message = message
+        self.messages: List[Message] = [placeholder]
+        self.shown: List[str] = [PLACEHOLDER_TEXT]
+
+    async def show(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        # Chunks that are complete are final and are only edited again if the split
+        # moved; the text that doesn't fit yet goes into a new message, so delivery
+        # of a long answer runs alongside its generation.
+        chunks = split_message(text)
+        for index, chunk in enumerate(chunks):
+            markup = reply_markup if index == len(chunks) - 1 else None
+            if index < len(self.messages):
+                if chunk != self.shown[index] or markup is not None:
+                    await _edit(self.messages[index], chunk, reply_markup=markup)
+                    self.shown[index] = chunk
+            else:
+                with span("telegram_send"):
+                    self.messages.append(await self.message.reply_text(chunk, reply_markup=markup))
+                self.shown.append(chunk)
+        # An answer that started over can be shorter than what was shown before.
+        for extra in self.messages[len(chunks):]:
+            await extra.delete()
+        del self.messages[len(chunks):], self.shown[len(chunks):]
+
+async def reply_streaming(
+    message: Message,
+    deltas: AsyncIterator[Union[str, StreamRestarted]],
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    feature: str = "text",
+) -> str:
+    """Send a placeholder reply and progressively edit it as text deltas arrive.
+
+    Edits are throttled by time and by the amount of new text so a single chat stays
+    well below Telegram's edit rate limit. Answers longer than one message continue
+    in follow-up messages. Returns the full text of the answer.
+    """
+    started = time.monotonic()
+    with span("telegram_send"):
+        placeholder = await message.reply_text(PLACEHOLDER_TEXT)
+    reply = _StreamedReply(message, placeholder)
+
+    parts = []
+    length = 0
+    sent_length = 0
+    # The first text is shown as soon as it arrives; only later edits are throttled.
+    last_edit = float("-inf")
+    first_token_at = None
+
+    async for delta in deltas:
+        if isinstance(delta, StreamRestarted):
+            # The text so far is replaced by the next delta, which is shown right away.
+            parts = []
+            length = sent_length = 0
+            continue
+        if not delta:
+            continue
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+        parts.append(delta)
+        length += len(delta)
+
+        now = time.monotonic()
+        if not sent_length or (now - last_edit >= STREAM_EDIT_INTERVAL and length - sent_length >= STREAM_EDIT_MIN_CHARS):
+            await reply.show("".join(parts))
+            sent_length = length
+            last_edit = now
+
+    full_text = "".join(parts) or "Пустой ответ от Gemini API."
+    await reply.show(full_text, reply_markup=reply_markup)
+
+    finished = time.monotonic()
+    ttft = (first_token_at - started) if first_token_at is not None else None
+    if ttft is not None:
+        record_span("reply_first_token", time.perf_counter() - (finished - started), ttft)
+    PAYLOAD_BYTES.observe(len(full_text.encode("utf-8")), kind="reply_text")
+    logger.info(
+        "Streamed %s reply: ttft=%s total=%.3fs chars=%d messages=%d",
+        feature,
+        f"{ttft:.3f}s" if ttft is not None else "n/a",
+        finished - started,
+        length,
+        len(reply.messages),
+    )
+    return full_text
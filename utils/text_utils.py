@@ -0,0 +1,95 @@
+from collections import deque
+from typing import List, Optional
+
+MAX_MESSAGE_LENGTH = 4096  # in UTF-16 code units, as Telegram counts them
+FENCE = "```"
+
+def utf16_len(text: str) -> int:
+    """Length of ``text`` as Telegram counts it: characters outside the BMP, e.g. emoji, count twice."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _fit(line: str, width: int) -> int:
+    # Number of characters of ``line`` that fit into ``width`` UTF-16 code units.
+    units = 0
+    for index, char in enumerate(line):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > width:
+            return index
+    return len(line)
+
+def _fence_after(lines: List[str], fence: Optional[str] = None) -> Optional[str]:
+    """Return the opening line of the code fence still open after ``lines``, if any."""
+    for line in lines:
+        if line.lstrip().startswith(FENCE):
+            fence = None if fence else line.strip()
+    return fence
+
+def _wrap_line(line: str, width: int) -> List[str]:
+    # Lines that don't fit into a message on their own are broken at spaces, or hard.
+    pieces = []
+    while utf16_len(line) > width:
+        # At least one character per piece, even if it alone is wider than ``width``.
+        end = max(_fit(line, width), 1)
+        cut = line.rfind(" ", end // 2, end)
+        if cut <= 0:
+            cut = end
+        pieces.append(line[:cut])
+        line = line[cut:].lstrip(" ")
+    pieces.append(line)
+    return pieces
+
+def split_message(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Split ``text`` into messages of at most ``limit`` UTF-16 code units.
+
+    Messages are cut at paragraph breaks where possible, otherwise at line breaks.
+    A code block that has to be cut is closed at the end of one message and
+    reopened, with the same language tag, at the start of the next, so every
+    message is valid Markdown on its own.
+    """
+    if utf16_len(text) <= limit:
+        return [text]
+
+    lines = text.split("\n")
+    longest_fence = max((utf16_len(line.strip()) for line in lines if line.lstrip().startswith(FENCE)), default=0)
+    # Room for a reopened fence at the start and a closing one at the end. Fence
+    # lines longer than a quarter of the limit are wrapped down to that size, so
+    # ordinary lines always keep most of a message.
+    budget = limit - len(FENCE) - 1
+    fence_width = min(longest_fence, limit // 4)
+    width = max(budget - fence_width - 1, 1)
+
+    def wrap(line: str) -> List[str]:
+        if line.lstrip().startswith(FENCE) and utf16_len(line.strip()) > fence_width:
+            return _wrap_line(line.strip(), fence_width)
+        return _wrap_line(line, width)
+
+    pending = deque(piece for line in lines for piece in wrap(line))
+
+    chunks = []
+    fence = None
+    while pending:
+        current = [fence] if fence else []
+        start = len(current)
+        size = utf16_len(fence) if fence else 0
+        while pending:
+            added = utf16_len(pending[0]) + (1 if current else 0)
+            if size + added > budget and len(current) > start:
+                break
+            current.append(pending.popleft())
+            size += added
+
+        if pending:
+            # Prefer ending at a blank line in the second half of the message.
+            for index in range(len(current) - 1, max(start, len(current) // 2), -1):
+                if not current[index].strip():
+                    pending.extendleft(reversed(current[index + 1:]))
+                    del current[index:]
+                    break
+
+        fence = _fence_after(current)
+        if fence:
+            current.append(FENCE)
+        chunk = "\n".join(current).strip("\n")
+        if chunk:
+            chunks.append(chunk)
+    return chunks